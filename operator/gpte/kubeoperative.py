@@ -1,161 +1,546 @@
+import aiohttp
+import asyncio
+import concurrent.futures
+import copy
 import inflection
+import json
 import kubernetes
 import logging
 import os
 import os.path
 import re
+import socket
+import ssl
 import threading
 import time
+import urllib3
 
-def _jsonpatch_path(*path):
-    return '/' + '/'.join([
-        p.replace('~', '~0').replace('/', '~1') for p in path
-    ])
-
-def _jsonpatch_from_diff(a, b, path):
-    if isinstance(a, dict) and isinstance(b, dict):
-        for op in _jsonpatch_from_dict_diff(a, b, path):
-            yield op
-    elif isinstance(a, list) and isinstance(b, list):
-        for op in _jsonpatch_from_list_diff(a, b, path):
-            yield op
-    elif a != b:
-        yield dict(op='replace', path=_jsonpatch_path(*path), value=b)
-
-def _jsonpatch_from_dict_diff(a, b, path):
-    for k, v in a.items():
-        if k in b:
-            for op in _jsonpatch_from_diff(v, b[k], path + [k]):
-                yield op
-        else:
-            yield dict(op='remove', path=_jsonpatch_path(*path, k))
-    for k, v in b.items():
-        if k not in a:
-            yield dict(op='add', path=_jsonpatch_path(*path, k), value=v)
-
-def _jsonpatch_from_list_diff(a, b, path):
-    for i in range(min(len(a), len(b))):
-        for op in _jsonpatch_from_diff(a[i], b[i], path + [str(i)]):
-            yield op
-    for i in range(len(a) - 1, len(b) -1, -1):
-        yield dict(op='remove', path=_jsonpatch_path(*path, str(i)))
-    for i in range(len(a), len(b)):
-        yield dict(op='add', path=_jsonpatch_path(*path, str(i)), value=b[i])
+from gpte.util import TokenBucket
+
+def _jsonpatch_path(node):
+    """
+    Return JSON pointer for path node, nodes are (parent, key) tuples.
+    """
+    segments = []
+    while node:
+        node, segment = node
+        if isinstance(segment, int):
+            segment = str(segment)
+        elif '~' in segment or '/' in segment:
+            segment = segment.replace('~', '~0').replace('/', '~1')
+        segments.append(segment)
+    segments.reverse()
+    return '/' + '/'.join(segments)
+
+def _jsonpatch_diff(a, b, ops):
+    """
+    Generate (op, value, path node) for JSON patch operations to change a into
+    b, restricted to operations named in ops.
+
+    Differences are found with an explicit stack rather than recursion and
+    identical or equal subtrees are skipped without descending into them.
+    Operations excluded by ops are never queued.
+    """
+    if a is b:
+        return
+    add = 'add' in ops
+    remove = 'remove' in ops
+    replace = 'replace' in ops
+    # Stack items are (True, a, b, path node) to diff or (False, op, value, path node)
+    stack = [(True, a, b, None)]
+    while stack:
+        is_diff, x, y, node = stack.pop()
+        if not is_diff:
+            yield x, y, node
+            continue
+        if isinstance(x, dict) and isinstance(y, dict):
+            work = []
+            for k, v in x.items():
+                if k in y:
+                    w = y[k]
+                    if v is not w and v != w:
+                        work.append((True, v, w, (node, k)))
+                elif remove:
+                    work.append((False, 'remove', None, (node, k)))
+            if add:
+                for k, w in y.items():
+                    if k not in x:
+                        work.append((False, 'add', w, (node, k)))
+            work.reverse()
+            stack.extend(work)
+        elif isinstance(x, list) and isinstance(y, list):
+            work = []
+            for i in range(min(len(x), len(y))):
+                v = x[i]
+                w = y[i]
+                if v is not w and v != w:
+                    work.append((True, v, w, (node, i)))
+            if remove:
+                for i in range(len(x) - 1, len(y) - 1, -1):
+                    work.append((False, 'remove', None, (node, i)))
+            if add:
+                for i in range(len(x), len(y)):
+                    work.append((False, 'add', y[i], (node, i)))
+            work.reverse()
+            stack.extend(work)
+        elif replace and x != y:
+            yield 'replace', y, node
 
 def jsonpatch_from_diff(a, b):
-    return [ item for item in _jsonpatch_from_diff(a, b, []) ]
+    """
+    Return JSON patch operations to change a into b.
+    """
+    return [
+        dict(op=op, path=_jsonpatch_path(node))
+        if op == 'remove' else
+        dict(op=op, path=_jsonpatch_path(node), value=value)
+        for op, value, node in _jsonpatch_diff(a, b, ('add', 'remove', 'replace'))
+    ]
+
+def jsonpatch_diff_count(a, b, ops=('add', 'remove', 'replace'), path_predicate=None):
+    """
+    Return count of JSON patch operations in ops needed to change a into b or
+    None if path_predicate returns false for the path of any such operation.
+
+    Differences are streamed so that the diff stops at the first rejected path
+    and no operations are built. Paths are only built if there is a predicate.
+    """
+    count = 0
+    for op, value, node in _jsonpatch_diff(a, b, ops):
+        if path_predicate and not path_predicate(_jsonpatch_path(node)):
+            return None
+        count += 1
+    return count
+
+class UpdateFilters(object):
+    """
+    Compiled list of update filters for restricting patch operations.
+
+    Each filter has a pathMatch regular expression which must match the full
+    patch path, including every alternative of a top level alternation, and
+    optional allowedOps. The first matching filter determines
+    whether an operation is allowed. Patterns are combined into a single
+    regular expression so that each path is matched once rather than against
+    each filter in turn. Leading global inline flags such as (?i) are applied
+    to the pattern as scoped flags so that patterns can be combined. Filters
+    with an invalid pathMatch are logged and skipped.
+    """
+    global_flags_regex = re.compile(r'\(\?([aiLmsux]+)\)')
+
+    def __init__(self, update_filters, logger=None):
+        self.logger = logger or logging.getLogger('update_filters')
+        self.update_filters = update_filters
+        self.allowed_ops = {}
+        self.regexes = []
+        patterns = []
+        group = 1
+        for f in update_filters:
+            pattern = self.__scope_global_flags(f['pathMatch'])
+            try:
+                regex = re.compile(pattern)
+            except re.error as e:
+                self.logger.warning('Ignoring update filter with invalid pathMatch %r: %s', f['pathMatch'], e)
+                continue
+            allowed_ops = frozenset(f.get('allowedOps', ['add','remove','replace']))
+            self.allowed_ops[group] = allowed_ops
+            self.regexes.append((regex, allowed_ops))
+            patterns.append('(' + pattern + ')')
+            group += 1 + regex.groups
+        try:
+            self.regex = re.compile('|'.join(patterns)) if patterns else None
+        except re.error:
+            # Patterns may not be combinable, such as with duplicate group names
+            self.regex = None
+
+    def __scope_global_flags(self, path_match):
+        """
+        Return anchored pattern for pathMatch with leading global inline flags
+        converted to scoped flags, which are allowed within the combined
+        pattern.
+        """
+        flags = ''
+        match = self.global_flags_regex.match(path_match)
+        while match:
+            flags += match.group(1)
+            path_match = path_match[match.end():]
+            match = self.global_flags_regex.match(path_match)
+        return '(?' + flags + ':' + path_match + ')$' if flags else '(?:' + path_match + ')$'
+
+    def __bool__(self):
+        return bool(self.update_filters)
+
+    def allows(self, op, path):
+        if not self.update_filters:
+            return True
+        if self.regex:
+            match = self.regex.match(path)
+            return match != None and op in self.allowed_ops[match.lastindex]
+        for regex, allowed_ops in self.regexes:
+            if regex.match(path):
+                return op in allowed_ops
+        return False
 
 def filter_patch_item(update_filters, item):
     if not update_filters:
         return True
-    path = item['path']
-    op = item['op']
-    for f in update_filters:
-        allowed_ops = f.get('allowedOps', ['add','remove','replace'])
-        if re.match(f['pathMatch'] + '$', path):
-            if op not in allowed_ops:
-                return False
-            return True
-    return False
+    if not isinstance(update_filters, UpdateFilters):
+        update_filters = UpdateFilters(update_filters)
+    return update_filters.allows(item['op'], item['path'])
 
 def create_patch(resource, update, update_filters=None):
+    """
+    Return JSON patch to update resource restricted by update filters, which
+    may be an UpdateFilters instance or a list of update filter definitions.
+    """
     # FIXME - There should be some sort of warning about patch items being rejected?
-    return [
-        item for item in jsonpatch_from_diff(
-            resource,
-            update
-        ) if filter_patch_item(update_filters, item)
-    ]
+    if not update_filters:
+        return jsonpatch_from_diff(resource, update)
+    if not isinstance(update_filters, UpdateFilters):
+        update_filters = UpdateFilters(update_filters)
+    patch = []
+    for op, value, node in _jsonpatch_diff(resource, update, ('add', 'remove', 'replace')):
+        path = _jsonpatch_path(node)
+        if update_filters.allows(op, path):
+            if op == 'remove':
+                patch.append(dict(op=op, path=path))
+            else:
+                patch.append(dict(op=op, path=path, value=value))
+    return patch
+
+def auth_headers_from_configuration(configuration):
+    """
+    Return HTTP headers for authentication from kubernetes client configuration.
+    """
+    return {
+        auth['key']: auth['value']
+        for auth in configuration.auth_settings().values()
+        if auth['in'] == 'header' and auth['value']
+    }
+
+def ssl_context_from_configuration(configuration):
+    """
+    Return SSL context for aiohttp matching kubernetes client configuration.
+    """
+    ssl_context = ssl.create_default_context(cafile=configuration.ssl_ca_cert)
+    if configuration.cert_file:
+        ssl_context.load_cert_chain(configuration.cert_file, configuration.key_file)
+    if not configuration.verify_ssl:
+        ssl_context.check_hostname = False
+        ssl_context.verify_mode = ssl.CERT_NONE
+    return ssl_context
+
+def timed_connection_pool_classes(hooks):
+    """
+    Return urllib3 connection pool classes by scheme which report seconds
+    spent waiting for a connection from the pool to each of hooks.
+    """
+    pool_classes = {}
+    for scheme, pool_class in urllib3.poolmanager.pool_classes_by_scheme.items():
+        def _get_conn(self, timeout=None, pool_class=pool_class):
+            start = time.monotonic()
+            try:
+                return pool_class._get_conn(self, timeout)
+            finally:
+                waited = time.monotonic() - start
+                for hook in hooks:
+                    hook(waited)
+        pool_classes[scheme] = type('Timed' + pool_class.__name__, (pool_class,), {'_get_conn': _get_conn})
+    return pool_classes
+
+def api_call_verb_and_resource(resource_path, method, path_params, query_params):
+    """
+    Return Kubernetes API verb and resource name for an API client call.
+    """
+    segments = resource_path.strip('/').split('/')
+    if segments[0] == 'api':
+        segments = segments[2:]
+    elif segments[0] == 'apis':
+        segments = segments[3:]
+    if len(segments) > 2 and segments[0] == 'namespaces':
+        segments = segments[2:]
+    if not segments:
+        return method.lower(), 'discovery'
+    resource = segments[0]
+    if resource.startswith('{'):
+        resource = (path_params or {}).get(resource[1:-1], resource)
+    if len(segments) > 2:
+        resource += '/' + segments[2]
+    has_name = len(segments) > 1
+    if method == 'GET':
+        if has_name:
+            verb = 'get'
+        elif dict(query_params or []).get('watch'):
+            verb = 'watch'
+        else:
+            verb = 'list'
+    elif method == 'DELETE':
+        verb = 'delete' if has_name else 'deletecollection'
+    else:
+        verb = {
+            'PATCH': 'patch',
+            'POST': 'create',
+            'PUT': 'update',
+        }.get(method, method.lower())
+    return verb, resource
+
+def is_newer_resource_version(resource_version, seen_version):
+    """
+    Return whether resource_version is newer than seen_version. Versions are
+    compared as integers where possible, otherwise any other version is newer.
+    """
+    if resource_version.isdigit() and seen_version.isdigit():
+        return int(resource_version) > int(seen_version)
+    return resource_version != seen_version
+
+def resource_key(resource):
+    metadata = resource['metadata']
+    return (metadata.get('namespace'), metadata['name'])
+
+class ResourceCache(object):
+    """
+    Local cache of resources maintained from watch events and API responses.
+
+    Resources are tracked by plural, namespace, and name along with their
+    resourceVersion so that a stale copy of a resource does not replace a
+    newer one. Removed resources leave a tombstone with the deleted
+    resourceVersion so that a response read before the delete is not cached
+    after it. A disabled cache never returns a cached resource.
+    """
+    def __init__(self, enabled=True, tombstone_ttl=300):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.resources = {}
+        self.tombstones = {}
+        self.tombstone_ttl = tombstone_ttl
+
+    def __len__(self):
+        return len(self.resources)
+
+    def _prune_tombstones(self):
+        expired = time.monotonic() - self.tombstone_ttl
+        for key, (resource_version, removed) in list(self.tombstones.items()):
+            if removed < expired:
+                del self.tombstones[key]
+
+    def get(self, plural, namespace, name):
+        """
+        Return copy of cached resource or None if the resource is not cached.
+        """
+        if not self.enabled:
+            return None
+        with self.lock:
+            resource = self.resources.get((plural, namespace, name))
+        if resource:
+            return copy.deepcopy(resource)
+
+    def put(self, plural, resource):
+        """
+        Cache copy of resource unless the same or a newer version has already
+        been cached or removed.
+        """
+        if not self.enabled:
+            return
+        metadata = resource['metadata']
+        key = (plural, metadata.get('namespace'), metadata['name'])
+        resource_version = metadata.get('resourceVersion', '')
+        resource = copy.deepcopy(resource)
+        with self.lock:
+            tombstone = self.tombstones.get(key)
+            if tombstone:
+                if not is_newer_resource_version(resource_version, tombstone[0]):
+                    return
+                # Resource recreated since it was removed
+                del self.tombstones[key]
+            current = self.resources.get(key)
+            if current and not is_newer_resource_version(
+                resource_version, current['metadata'].get('resourceVersion', '')
+            ):
+                return
+            self.resources[key] = resource
+
+    def remove(self, plural, namespace, name, resource_version=None):
+        """
+        Remove resource from cache, recording a tombstone if the deleted
+        resourceVersion is given.
+        """
+        key = (plural, namespace, name)
+        with self.lock:
+            self.resources.pop(key, None)
+            if resource_version:
+                self._prune_tombstones()
+                self.tombstones[key] = (resource_version, time.monotonic())
 
 class Watcher(object):
+    """
+    Watch for a resource kind, optionally restricted to a namespace. Watches
+    run as tasks of the operative's WatchMultiplexer and pass each event to
+    the handler in a thread of the multiplexer's handler pool.
+
+    The watch resumes from the last seen resourceVersion, kept current by
+    watch bookmarks. Resources are only relisted when the resourceVersion
+    has expired, and the relist is compared to the last known state of each
+    resource so that only changes are passed to the handler.
+
+    A metadata only watch requests resources as PartialObjectMetadata and
+    keeps only the name, namespace, and resourceVersion of each resource.
+    """
     def __init__(self, operative, kind,
         group=None,
+        label_selector=None,
+        metadata_only=False,
         name=None,
         namespace=None,
-        preload=False,
+        plural=None,
         version='v1'
     ):
         self.logger = logging.getLogger('watch.{}/{}'.format(namespace, name) if namespace else 'watch.{}'.format(name))
         self.name = name
         self.operative = operative
-        self._preload = preload
-        self.thread = threading.Thread(
-            name = self.name,
-            target = self.watch_loop
-        )
+        self.references = None
+        self.cache = {}
+        self.kind = kind
+        self.label_selector = label_selector
+        self.metadata_only = metadata_only
+        self.errors = 0
+        self.events = 0
+        self.relists = 0
+        self.resource_version = None
+        self.restarts = 0
+        self.running = False
+        if not plural:
+            plural = self.operative.kind_to_plural(group, version, kind)
         if group:
-            self.__init_custom_resource_watcher(
-                group=group,
-                namespace=namespace,
-                kind=kind,
-                version=version
-            )
-        else:
-            self.__init_core_resource_watcher(
-                namespace=namespace,
-                kind=kind,
-                version=version
-            )
-
-    def __init_core_resource_watcher(self, namespace, kind, version):
-        if namespace:
-            self.method = getattr(
-                self.operative.core_v1_api,
-                'list_namespaced_' + inflection.underscore(kind)
-            )
-            self.method_args = (namespace,)
+            path = '/apis/{}/{}'.format(group, version)
         else:
-            self.method = getattr(
-                self.operative.core_v1_api,
-                'list_' + inflection.underscore(kind)
-            )
-            self.method_args = ()
-
-    def __init_custom_resource_watcher(self, group, namespace, kind, version):
-        plural = self.operative.kind_to_plural(group, version, kind)
+            path = '/api/{}'.format(version)
         if namespace:
-            self.method = self.operative.custom_objects_api.list_namespaced_custom_object
-            self.method_args = (
-                group,
-                version,
-                namespace,
-                plural
-            )
-        else:
-            self.method = self.operative.custom_objects_api.list_cluster_custom_object
-            self.method_args = (
-                group,
-                version,
-                plural
-            )
+            path += '/namespaces/{}'.format(namespace)
+        self.path = '{}/{}'.format(path, plural)
 
     def __call__(self, handler):
         self.handler=handler
 
-    def watch_loop(self):
-        while True:
-            try:
-                self.watch()
-            except Exception as e:
-                if isinstance(e, kubernetes.client.rest.ApiException) \
-                and e.status == 403:
-                    self.logger.exception("Forbidden response on watch: %s", e)
-                    del self.operative.watchers[self.name]
-                    return
-                else:
+    def _accept(self, kind):
+        if self.metadata_only:
+            return 'application/json;as={};g=meta.k8s.io;v=v1'.format(kind)
+        return 'application/json'
+
+    def _cache_entry(self, resource):
+        if not self.metadata_only:
+            return resource
+        metadata = resource['metadata']
+        return {
+            'metadata': {
+                key: metadata[key] for key in ('name', 'namespace', 'resourceVersion') if key in metadata
+            }
+        }
+
+    async def watch_loop(self):
+        self.running = True
+        try:
+            while True:
+                try:
+                    await self.watch()
+                except kubernetes.client.rest.ApiException as e:
+                    if e.status == 403:
+                        self.logger.exception("Forbidden response on watch: %s", e)
+                        with self.operative.watchers_lock:
+                            self.operative.watchers.pop(self.name, None)
+                        return
+                    self.errors += 1
+                    self.logger.exception("Error in watch loop: %s", e)
+                    await asyncio.sleep(30)
+                except Exception as e:
+                    self.errors += 1
                     self.logger.exception("Error in watch loop: %s", e)
-                    time.sleep(30)
+                    await asyncio.sleep(30)
+                if self.name not in self.operative.watchers:
+                    return
+                self.restarts += 1
+        finally:
+            self.running = False
 
-    def watch(self):
-        stream = kubernetes.watch.Watch().stream(self.method, *self.method_args)
-        for event in stream:
+    async def dispatch(self, event_type, resource):
+        try:
+            await self.operative.watch_multiplexer.dispatch(
+                self.handler, {'type': event_type, 'object': resource}, self.logger
+            )
+        except Exception as e:
+            self.logger.exception("Error handling %s event for %s", event_type, resource['metadata']['name'])
+
+    async def relist(self):
+        """
+        List all resources and pass changes since the last known state of
+        each resource to the handler as ADDED, MODIFIED, and DELETED events.
+        """
+        multiplexer = self.operative.watch_multiplexer
+        resources = {}
+        params = {'limit': 500}
+        if self.label_selector:
+            params['labelSelector'] = self.label_selector
+        resource_version = None
+        while True:
+            resource_list = await multiplexer.get(self.path, params, accept=self._accept('PartialObjectMetadataList'))
+            if not resource_version:
+                resource_version = resource_list['metadata']['resourceVersion']
+            for resource in resource_list.get('items', []):
+                # Items in lists of core resources do not include apiVersion and kind
+                resource.setdefault('apiVersion', resource_list['apiVersion'])
+                resource.setdefault('kind', self.kind)
+                resources[resource_key(resource)] = self._cache_entry(resource)
+            continue_token = resource_list['metadata'].get('continue')
+            if not continue_token:
+                break
+            params['continue'] = continue_token
+
+        self.relists += 1
+        cache = self.cache
+        self.cache = resources
+        self.resource_version = resource_version
+
+        for key, resource in resources.items():
+            cached = cache.pop(key, None)
+            if not cached:
+                await self.dispatch('ADDED', resource)
+            elif cached['metadata']['resourceVersion'] != resource['metadata']['resourceVersion']:
+                await self.dispatch('MODIFIED', resource)
+        for resource in cache.values():
+            await self.dispatch('DELETED', resource)
+
+    async def watch(self):
+        if not self.resource_version:
+            await self.relist()
+        multiplexer = self.operative.watch_multiplexer
+        params = {
+            'allowWatchBookmarks': 'true',
+            'resourceVersion': self.resource_version,
+            'watch': 'true',
+        }
+        if self.label_selector:
+            params['labelSelector'] = self.label_selector
+        stream = multiplexer.stream(self.path, params, accept=self._accept('PartialObjectMetadata'))
+        try:
+            await self.process_stream(stream)
+        except kubernetes.client.rest.ApiException as e:
+            if e.status != 410:
+                raise
+            self.logger.info('Relisting for watch %s, resourceVersion expired', self.path)
+            self.resource_version = None
+        finally:
+            await stream.aclose()
+
+    async def process_stream(self, stream):
+        async for event in stream:
             # Exit without processing if watch was removed
             if not self.name in self.operative.watchers:
                 return
 
+            self.events += 1
+
             # Handle event object
             event_obj = event['object']
-            if event['type'] == 'ERROR' \
+            event_type = event['type']
+            if event_type == 'ERROR' \
             and event_obj['kind'] == 'Status':
                 self.logger.debug('Watch %s - reason %s, %s',
                     event_obj['status'],
@@ -163,21 +548,176 @@ class Watcher(object):
                     event_obj['message']
                 )
                 if event_obj['status'] == 'Failure':
-                    if event_obj['reason'] in ('Expired', 'Gone'):
-                        self.logger.info('Restarting watch %s, reason %s', self.method_args, event_obj['reason'])
+                    if event_obj.get('code') == 410 \
+                    or event_obj['reason'] in ('Expired', 'Gone'):
+                        self.logger.info('Relisting for watch %s, reason %s', self.path, event_obj['reason'])
+                        self.resource_version = None
                         return
                     else:
                         raise Exception("Watch failure: reason {}, message {}".format(event_obj['reason'], event_obj['message']))
+                continue
+
+            self.resource_version = event_obj['metadata']['resourceVersion']
+            if event_type == 'BOOKMARK':
+                continue
+
+            key = resource_key(event_obj)
+            if event_type == 'DELETED':
+                self.cache.pop(key, None)
             else:
-                try:
-                    self.handler(event, self.logger)
-                except Exception as e:
-                    self.logger.exception("Error handling event %s", event)
+                self.cache[key] = self._cache_entry(event_obj)
+
+            await self.dispatch(event_type, event_obj)
 
     def start(self):
-        if not self.thread.is_alive():
+        self.operative.watch_multiplexer.start(self)
+
+    def stop(self):
+        self.operative.watch_multiplexer.stop(self)
+
+class WatchMultiplexer(object):
+    """
+    Run all resource watches as tasks on a single asyncio event loop thread.
+
+    Concurrent watch connection attempts are limited by max_connecting and
+    event handlers run in a pool of handler_workers threads, except coroutine
+    handlers which are awaited on the watch loop. Events for each watch are
+    handled in order.
+    """
+    def __init__(self, operative, handler_workers=10, max_connecting=10):
+        self.handler_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers = handler_workers,
+            thread_name_prefix = 'watch_handler',
+        )
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger('watch')
+        self.loop = None
+        self.max_connecting = max_connecting
+        self.operative = operative
+        self.session = None
+        self.ssl_context = None
+        self.tasks = {}
+
+    def __ensure_loop(self):
+        with self.lock:
+            if self.loop:
+                return
+            self.loop = asyncio.new_event_loop()
+            self.thread = threading.Thread(
+                name = 'watch_multiplexer',
+                daemon = True,
+                target = self.__run_loop,
+            )
             self.thread.start()
 
+    def __run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.connect_semaphore = asyncio.Semaphore(self.max_connecting)
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
+
+    def __start_task(self, watcher):
+        task = self.tasks.get(watcher.name)
+        if task and not task.done():
+            return
+        self.tasks[watcher.name] = self.loop.create_task(watcher.watch_loop())
+
+    def __stop_task(self, name):
+        task = self.tasks.pop(name, None)
+        if task:
+            task.cancel()
+
+    async def __shutdown(self):
+        tasks = list(self.tasks.values())
+        self.tasks.clear()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self.session:
+            await self.session.close()
+
+    @property
+    def task_count(self):
+        return len(self.tasks)
+
+    async def dispatch(self, handler, event, logger):
+        if asyncio.iscoroutinefunction(handler):
+            await handler(event, logger)
+        else:
+            await self.loop.run_in_executor(self.handler_executor, handler, event, logger)
+
+    def shutdown(self):
+        if not self.loop:
+            return
+        asyncio.run_coroutine_threadsafe(self.__shutdown(), self.loop).result(timeout=10)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout=10)
+        self.handler_executor.shutdown(wait=False)
+
+    def start(self, watcher):
+        self.__ensure_loop()
+        self.loop.call_soon_threadsafe(self.__start_task, watcher)
+
+    def stop(self, watcher):
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.__stop_task, watcher.name)
+
+    async def __request(self, path, params, accept):
+        configuration = self.operative.api_configuration
+        if not self.session:
+            self.ssl_context = ssl_context_from_configuration(configuration)
+            self.session = aiohttp.ClientSession(
+                timeout = aiohttp.ClientTimeout(total=None, sock_connect=30),
+            )
+        headers = { 'Accept': accept }
+        headers.update(auth_headers_from_configuration(configuration))
+
+        async with self.connect_semaphore:
+            response = await self.session.get(
+                configuration.host + path,
+                headers = headers,
+                params = params,
+                proxy = configuration.proxy,
+                ssl = self.ssl_context,
+            )
+        if response.status != 200:
+            try:
+                e = kubernetes.client.rest.ApiException(status=response.status, reason=response.reason)
+                e.body = await response.text()
+            finally:
+                response.release()
+            raise e
+        return response
+
+    async def get(self, path, params, accept='application/json'):
+        """
+        Request path from API and return the JSON response.
+        """
+        response = await self.__request(path, params, accept)
+        try:
+            return json.loads(await response.read())
+        finally:
+            response.release()
+
+    async def stream(self, path, params, accept='application/json'):
+        """
+        Request path from API and yield each JSON object from response lines.
+        """
+        response = await self.__request(path, params, accept)
+        try:
+            # Split lines manually as objects may exceed the stream reader line limit
+            buf = b''
+            async for chunk in response.content.iter_any():
+                buf += chunk
+                while b'\n' in buf:
+                    line, buf = buf.split(b'\n', 1)
+                    if line.strip():
+                        yield json.loads(line)
+        finally:
+            response.release()
+
 class KubeOperative(object):
 
     def __init__(
@@ -185,12 +725,29 @@ class KubeOperative(object):
         operator_domain=None,
         operator_namespace=None
     ):
+        self.api_call_hooks = []
+        self.api_connection_wait_hooks = []
         self.api_groups = {}
+        self.api_rate_limit_hooks = []
+        self.api_read_rate_limiter = TokenBucket(
+            rate = float(os.environ.get('API_QPS', 50)),
+            burst = int(os.environ.get('API_BURST', 100)),
+        )
+        self.api_write_rate_limiter = TokenBucket(
+            rate = float(os.environ.get('API_WRITE_QPS', 20)),
+            burst = int(os.environ.get('API_WRITE_BURST', 40)),
+        )
         self.watchers = {}
+        self.watchers_lock = threading.RLock()
         self.__init_logger()
         self.__init_domain(operator_domain)
         self.__init_namespace(operator_namespace)
         self.__init_kube_apis()
+        self.watch_multiplexer = WatchMultiplexer(
+            self,
+            handler_workers = int(os.environ.get('WATCH_HANDLER_WORKERS', 10)),
+            max_connecting = int(os.environ.get('WATCH_MAX_CONNECTING', 10)),
+        )
 
     def __init_domain(self, operator_domain):
         if operator_domain:
@@ -220,13 +777,64 @@ class KubeOperative(object):
         else:
             kubernetes.config.load_kube_config()
 
-        self.core_v1_api = kubernetes.client.CoreV1Api()
-        self.custom_objects_api = kubernetes.client.CustomObjectsApi()
+        self.api_request_timeout = (
+            float(os.environ.get('API_CONNECT_TIMEOUT', 10)),
+            float(os.environ.get('API_READ_TIMEOUT', 60)),
+        )
+        self.api_configuration = kubernetes.client.Configuration.get_default_copy()
+        self.api_configuration.connection_pool_maxsize = int(os.environ.get('API_CONNECTION_POOL_SIZE', 20))
 
-        # Hack to allow json-patch, hopefully we can remove this in the future
-        self.custom_objects_api_jsonpatch = kubernetes.client.CustomObjectsApi()
-        self.custom_objects_api_jsonpatch.api_client.select_header_content_type = \
+        api_client = kubernetes.client.ApiClient(self.api_configuration)
+        self.__init_connection_pool(api_client.rest_client.pool_manager)
+        self.core_v1_api = kubernetes.client.CoreV1Api(api_client)
+        self.custom_objects_api = kubernetes.client.CustomObjectsApi(api_client)
+
+        # Hack to allow json-patch, hopefully we can remove this in the future.
+        # Copy of the API client shares its REST client and connection pool.
+        jsonpatch_api_client = copy.copy(api_client)
+        jsonpatch_api_client.select_header_content_type = \
             lambda _ : 'application/json-patch+json'
+        self.custom_objects_api_jsonpatch = kubernetes.client.CustomObjectsApi(jsonpatch_api_client)
+
+        for api_client in (api_client, jsonpatch_api_client):
+            self.__instrument_api_client(api_client)
+
+    def __init_connection_pool(self, pool_manager):
+        """
+        Configure connection pools to wait for a free connection rather than
+        open connections beyond the pool size, with optional TCP keep-alive.
+        """
+        pool_manager.connection_pool_kw['block'] = True
+        if os.environ.get('API_KEEPALIVE', 'true').lower() == 'true':
+            pool_manager.connection_pool_kw['socket_options'] = \
+                urllib3.connection.HTTPConnection.default_socket_options + [
+                    (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+                ]
+        pool_manager.pool_classes_by_scheme = timed_connection_pool_classes(self.api_connection_wait_hooks)
+
+    def __instrument_api_client(self, api_client):
+        """
+        Wrap API client calls to apply client side rate limits, with separate
+        budgets for reads and writes, apply the default request timeout, and
+        report each call to api_call_hooks.
+        """
+        call_api = api_client.call_api
+        def instrumented_call_api(resource_path, method, path_params=None, query_params=None, *args, **kwargs):
+            if method in ('GET', 'HEAD'):
+                budget, rate_limiter = 'read', self.api_read_rate_limiter
+            else:
+                budget, rate_limiter = 'write', self.api_write_rate_limiter
+            waited = rate_limiter.acquire()
+            for hook in self.api_rate_limit_hooks:
+                hook(budget, waited)
+            if self.api_call_hooks:
+                verb, resource = api_call_verb_and_resource(resource_path, method, path_params, query_params)
+                for hook in self.api_call_hooks:
+                    hook(verb, resource)
+            if kwargs.get('_request_timeout') is None:
+                kwargs['_request_timeout'] = self.api_request_timeout
+            return call_api(resource_path, method, path_params, query_params, *args, **kwargs)
+        api_client.call_api = instrumented_call_api
 
     def create_resource(self, resource_definition):
         if '/' in resource_definition['apiVersion']:
@@ -389,28 +997,36 @@ class KubeOperative(object):
                 raise
 
     def kind_to_plural(self, group, version, kind):
-        if group in self.api_groups \
-        and version in self.api_groups[group]:
-            for resource in self.api_groups[group][version]['resources']:
-                if resource['kind'] == kind:
-                    return resource['name']
+        plural = self.kind_to_plural_from_api_groups(group, version, kind)
+        if plural:
+            return plural
 
         resp = self.custom_objects_api.api_client.call_api(
-            '/apis/{}/{}'.format(group,version),
+            '/apis/{}/{}'.format(group, version) if group else '/api/{}'.format(version),
             'GET',
             auth_settings=['BearerToken'],
             response_type='object'
         )
-        group_info = resp[0]
         if group not in self.api_groups:
             self.api_groups[group] = {}
-        self.api_groups[group][version] = group_info
+        self.api_groups[group][version] = resp[0]
 
-        for resource in group_info['resources']:
-            if resource['kind'] == kind:
-                return resource['name']
+        plural = self.kind_to_plural_from_api_groups(group, version, kind)
+        if plural:
+            return plural
         raise Exception('Unable to find kind {} in {}/{}', kind, group, version)
 
+    def kind_to_plural_from_api_groups(self, group, version, kind):
+        """
+        Return plural for kind from discovered API groups without making any
+        API request, None if not found.
+        """
+        if group in self.api_groups \
+        and version in self.api_groups[group]:
+            for resource in self.api_groups[group][version]['resources']:
+                if resource['kind'] == kind:
+                    return resource['name']
+
     def patch_core_resource(self, kind, namespace, name, patch):
 
         # Hack to allow json-patch, hopefully we can remove this in the future
@@ -544,7 +1160,7 @@ class KubeOperative(object):
                 patch=patch
             ), True
 
-    def create_watcher(self, kind, name=None, namespace=None, group=None, preload=False, version='v1'):
+    def create_watcher(self, kind, name=None, namespace=None, group=None, label_selector=None, metadata_only=False, plural=None, version='v1'):
         if not name:
             if group:
                 if namespace:
@@ -559,13 +1175,238 @@ class KubeOperative(object):
 
         w = Watcher(
             group=group,
+            label_selector=label_selector,
+            metadata_only=metadata_only,
             name=name,
             namespace=namespace,
             operative=self,
             kind=kind,
-            preload=preload,
+            plural=plural,
             version=version
         )
 
-        self.watchers[name] = w
+        with self.watchers_lock:
+            self.watchers[name] = w
+        return w
+
+    def ensure_watcher(self, name, handler, reference=None, **kwargs):
+        """
+        Create and start watcher with handler unless a watcher with the name
+        exists, then record reference to the watcher. Both happen under the
+        watchers lock so that the reference cannot be lost to the concurrent
+        removal of the last reference to the watcher.
+        """
+        with self.watchers_lock:
+            w = self.watchers.get(name)
+            if not w:
+                w = self.create_watcher(name=name, **kwargs)
+                w.handler = handler
+                w.start()
+            if reference:
+                self.add_watcher_reference(name, reference)
         return w
+
+    def add_watcher_reference(self, name, reference):
+        """
+        Record reference to watcher, a watcher with references is stopped when
+        all references are removed. Returns False if there is no watcher.
+        """
+        with self.watchers_lock:
+            w = self.watchers.get(name)
+            if not w:
+                return False
+            if w.references is None:
+                w.references = set()
+            w.references.add(reference)
+            return True
+
+    def remove_watcher_reference(self, reference):
+        """
+        Remove reference from all watchers and stop watchers that are no
+        longer referenced.
+        """
+        with self.watchers_lock:
+            for name, w in list(self.watchers.items()):
+                if w.references and reference in w.references:
+                    w.references.discard(reference)
+                    if not w.references:
+                        self.logger.info('Stopping unreferenced watch %s', name)
+                        self.watchers.pop(name, None)
+                        w.stop()
+
+class AsyncKubeOperative(object):
+    """
+    Asyncio variant of KubeOperative API methods for use from coroutines on
+    the operator event loop. Configuration, API discovery, rate limits, and
+    hooks are shared with the KubeOperative. The loop must be set to the
+    event loop before use of run() from other threads.
+    """
+    def __init__(self, operative):
+        self.loop = None
+        self.operative = operative
+        self.session = None
+
+    def run(self, coroutine):
+        """
+        Run coroutine on the event loop from a synchronous caller in another
+        thread and return the result.
+        """
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if running_loop is self.loop:
+            raise RuntimeError('run() called from event loop thread, await the coroutine instead')
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    async def close(self):
+        if self.session:
+            await self.session.close()
+            self.session = None
+
+    def get_session(self):
+        if not self.session:
+            configuration = self.operative.api_configuration
+            connect_timeout, read_timeout = self.operative.api_request_timeout
+            self.session = aiohttp.ClientSession(
+                connector = aiohttp.TCPConnector(
+                    limit = configuration.connection_pool_maxsize,
+                    ssl = ssl_context_from_configuration(configuration),
+                ),
+                timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout),
+            )
+        return self.session
+
+    async def request(self, method, path, body=None, content_type='application/json', params=None):
+        """
+        Make API request and return the JSON response. Responses with error
+        status raise kubernetes.client.rest.ApiException.
+        """
+        operative = self.operative
+        if method in ('GET', 'HEAD'):
+            budget, rate_limiter = 'read', operative.api_read_rate_limiter
+        else:
+            budget, rate_limiter = 'write', operative.api_write_rate_limiter
+        waited = rate_limiter.reserve()
+        if waited > 0:
+            await asyncio.sleep(waited)
+        for hook in operative.api_rate_limit_hooks:
+            hook(budget, waited)
+        if operative.api_call_hooks:
+            verb, resource = api_call_verb_and_resource(path, method, None, params)
+            for hook in operative.api_call_hooks:
+                hook(verb, resource)
+
+        configuration = operative.api_configuration
+        headers = { 'Accept': 'application/json' }
+        headers.update(auth_headers_from_configuration(configuration))
+        if body is not None:
+            headers['Content-Type'] = content_type
+            body = json.dumps(body)
+        async with self.get_session().request(
+            method,
+            configuration.host + path,
+            data = body,
+            headers = headers,
+            params = params,
+            proxy = configuration.proxy,
+        ) as response:
+            response_body = await response.text()
+            if response.status >= 400:
+                e = kubernetes.client.rest.ApiException(status=response.status, reason=response.reason)
+                e.body = response_body
+                raise e
+            return json.loads(response_body) if response_body else None
+
+    async def kind_to_plural(self, group, version, kind):
+        plural = self.operative.kind_to_plural_from_api_groups(group, version, kind)
+        if plural:
+            return plural
+        # Discover API group, also when cached discovery predates the kind
+        group_info = await self.request(
+            'GET', '/apis/{}/{}'.format(group, version) if group else '/api/{}'.format(version)
+        )
+        self.operative.api_groups.setdefault(group, {})[version] = group_info
+        plural = self.operative.kind_to_plural_from_api_groups(group, version, kind)
+        if plural:
+            return plural
+        raise Exception('Unable to find kind {} in {}/{}', kind, group, version)
+
+    async def resource_path(self, api_version, kind, name=None, namespace=None):
+        if '/' in api_version:
+            group, version = api_version.split('/')
+            path = '/apis/' + api_version
+        else:
+            group, version = None, api_version
+            path = '/api/' + api_version
+        if namespace:
+            path += '/namespaces/' + namespace
+        path += '/' + await self.kind_to_plural(group, version, kind)
+        if name:
+            path += '/' + name
+        return path
+
+    async def create_resource(self, resource_definition):
+        path = await self.resource_path(
+            resource_definition['apiVersion'], resource_definition['kind'],
+            namespace = resource_definition['metadata'].get('namespace', None),
+        )
+        return await self.request('POST', path, resource_definition)
+
+    async def delete_resource(self, api_version, kind, name, namespace=None):
+        path = await self.resource_path(api_version, kind, name, namespace)
+        try:
+            return await self.request('DELETE', path)
+        except kubernetes.client.rest.ApiException as e:
+            if e.status != 404:
+                raise
+
+    async def get_resource(self, api_version, kind, name, namespace=None):
+        path = await self.resource_path(api_version, kind, name, namespace)
+        try:
+            return await self.request('GET', path)
+        except kubernetes.client.rest.ApiException as e:
+            if e.status != 404:
+                raise
+
+    async def patch_resource(self, resource, patch, update_filters=None, subresource=None):
+        if not isinstance(patch, list):
+            if subresource == 'status':
+                patch = {"status": patch}
+            patch = create_patch(resource, patch, update_filters)
+        if not patch:
+            return resource, False
+        path = await self.resource_path(
+            resource['apiVersion'], resource['kind'], resource['metadata']['name'],
+            resource['metadata'].get('namespace', None),
+        )
+        if subresource:
+            path += '/' + subresource
+        return await self.request('PATCH', path, patch, 'application/json-patch+json'), True
+
+    async def patch_resource_status(self, resource, patch, update_filters=None):
+        return await self.patch_resource(resource, patch, update_filters, subresource='status')
+
+    # Methods matching kubernetes.client.CustomObjectsApi for namespaced custom resources
+
+    async def delete_namespaced_custom_object(self, group, version, namespace, plural, name):
+        return await self.request(
+            'DELETE', '/apis/{}/{}/namespaces/{}/{}/{}'.format(group, version, namespace, plural, name)
+        )
+
+    async def get_namespaced_custom_object(self, group, version, namespace, plural, name):
+        return await self.request(
+            'GET', '/apis/{}/{}/namespaces/{}/{}/{}'.format(group, version, namespace, plural, name)
+        )
+
+    async def patch_namespaced_custom_object(self, group, version, namespace, plural, name, body):
+        return await self.request(
+            'PATCH', '/apis/{}/{}/namespaces/{}/{}/{}'.format(group, version, namespace, plural, name),
+            body, 'application/json-patch+json' if isinstance(body, list) else 'application/merge-patch+json'
+        )
+
+    async def patch_namespaced_custom_object_status(self, group, version, namespace, plural, name, body):
+        return await self.request(
+            'PATCH', '/apis/{}/{}/namespaces/{}/{}/{}/status'.format(group, version, namespace, plural, name),
+            body, 'application/json-patch+json' if isinstance(body, list) else 'application/merge-patch+json'
+        )
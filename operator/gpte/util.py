@@ -1,8 +1,18 @@
+import asyncio
 import collections
+import collections.abc
+import contextlib
 import copy
 import datetime
+import functools
+import hashlib
+import heapq
+import itertools
 import jinja2
 import json
+import logging
+import threading
+import time
 
 class TimeDelta(object):
     def __init__(self, set_timedelta=None):
@@ -110,6 +120,371 @@ class TimeStamp(object):
     def utcnow(self):
         return TimeStamp()
 
+class CoalescingQueue(object):
+    """
+    Work queue which calls callback with a key and the most recent item put
+    for the key after a delay. Items put for a key while it is waiting replace
+    the waiting item so that only the latest is processed. Items for a key are
+    never processed concurrently.
+    """
+    def __init__(self, name, callback, delay=1.0, workers=1):
+        self.active = set()
+        self.callback = callback
+        self.coalesced = 0
+        self.condition = threading.Condition()
+        self.delay = delay
+        self.logger = logging.getLogger(name)
+        self.pending = {}
+        self.puts = 0
+        self.queue = collections.deque()
+        self.threads = [
+            threading.Thread(name='{}-{}'.format(name, i), daemon=True, target=self.run)
+            for i in range(workers)
+        ]
+
+    def __len__(self):
+        return len(self.pending)
+
+    def done(self, key):
+        """
+        Mark processing of key complete, queueing any item put for the key
+        while it was being processed.
+        """
+        with self.condition:
+            self.active.discard(key)
+            if key in self.pending:
+                self.queue.append((time.monotonic() + self.delay, key))
+                self.condition.notify()
+
+    def put(self, key, item):
+        with self.condition:
+            self.puts += 1
+            if key in self.pending:
+                self.coalesced += 1
+            elif key not in self.active:
+                self.queue.append((time.monotonic() + self.delay, key))
+                self.condition.notify()
+            # Items for active keys are queued when processing is done
+            self.pending[key] = item
+
+    def run(self):
+        while True:
+            key, item = self.wait_for_next()
+            try:
+                self.callback(key, item)
+            except Exception:
+                self.logger.exception("Error processing %s", key)
+            finally:
+                self.done(key)
+
+    def start(self):
+        for thread in self.threads:
+            if not thread.is_alive():
+                thread.start()
+
+    def wait_for_next(self):
+        with self.condition:
+            while True:
+                if not self.queue:
+                    self.condition.wait()
+                    continue
+                when, key = self.queue[0]
+                delay = when - time.monotonic()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+                self.queue.popleft()
+                self.active.add(key)
+                return key, self.pending.pop(key)
+
+class ExpiryScheduler(object):
+    """
+    Call callback with a key when the time scheduled for the key is reached.
+    Scheduled times are in seconds since the epoch. Scheduling a key again
+    replaces the previously scheduled time.
+    """
+    def __init__(self, name, callback):
+        self.callback = callback
+        self.condition = threading.Condition()
+        self.counter = itertools.count()
+        self.heap = []
+        self.logger = logging.getLogger(name)
+        self.scheduled = {}
+        self.thread = threading.Thread(name=name, daemon=True, target=self.run)
+
+    def __len__(self):
+        return len(self.scheduled)
+
+    def cancel(self, key):
+        with self.condition:
+            self.scheduled.pop(key, None)
+
+    def run(self):
+        while True:
+            key = self.wait_for_next()
+            try:
+                self.callback(key)
+            except Exception:
+                self.logger.exception("Error in expiry callback for %s", key)
+
+    def schedule(self, key, when):
+        with self.condition:
+            if self.scheduled.get(key) == when:
+                return
+            self.scheduled[key] = when
+            heapq.heappush(self.heap, (when, next(self.counter), key))
+            self.condition.notify()
+
+    def start(self):
+        if not self.thread.is_alive():
+            self.thread.start()
+
+    def wait_for_next(self):
+        with self.condition:
+            while True:
+                if not self.heap:
+                    self.condition.wait()
+                    continue
+                when, _, key = self.heap[0]
+                if self.scheduled.get(key) != when:
+                    # Discard entry which was cancelled or rescheduled
+                    heapq.heappop(self.heap)
+                    continue
+                delay = when - time.time()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+                heapq.heappop(self.heap)
+                del self.scheduled[key]
+                return key
+
+class LockTable(object):
+    """
+    Table of asyncio locks by key. Entries are created on demand and removed
+    when no coroutine holds or waits on the lock, so the table only grows
+    with the number of keys in use.
+    """
+    def __init__(self):
+        self.entries = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    @contextlib.asynccontextmanager
+    async def lock(self, key):
+        entry = self.entries.get(key)
+        if not entry:
+            entry = self.entries[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.entries[key]
+
+class MatchIndex(object):
+    """
+    Thread-safe index of match definitions by key for finding the definitions
+    which may match a template, where a match definition matches if each of
+    its values is found at the same path in the template.
+
+    Each definition is indexed by one of its scalar values, choosing the path
+    with the most distinct values across all definitions, so that lookup only
+    returns definitions which share the template value at an indexed path.
+    Definitions without scalar values are always returned. Candidates must be
+    checked against the full match definition. The index is rebuilt on lookup
+    after any change.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.matches = {}
+        self.index = None
+        self.unindexed = None
+
+    def __len__(self):
+        return len(self.matches)
+
+    def candidates(self, template):
+        """
+        Return list of keys for match definitions which may match template.
+        """
+        with self.lock:
+            if self.index is None:
+                self.__build_index()
+            ret = list(self.unindexed)
+            for path, keys_by_value in self.index.items():
+                value = template
+                for k in path:
+                    if not isinstance(value, dict) or k not in value:
+                        break
+                    value = value[k]
+                else:
+                    if _match_index_value(value):
+                        ret.extend(keys_by_value.get(value, ()))
+            return ret
+
+    def put(self, key, match):
+        with self.lock:
+            self.matches[key] = match
+            self.index = None
+
+    def remove(self, key):
+        with self.lock:
+            if self.matches.pop(key, None) is not None:
+                self.index = None
+
+    def __build_index(self):
+        leaves_by_key = {
+            key: list(_match_index_leaves(match, ())) for key, match in self.matches.items()
+        }
+        values_by_path = collections.defaultdict(set)
+        for leaves in leaves_by_key.values():
+            for path, value in leaves:
+                values_by_path[path].add(value)
+        self.index = collections.defaultdict(lambda: collections.defaultdict(list))
+        self.unindexed = []
+        for key, leaves in leaves_by_key.items():
+            if leaves:
+                path, value = max(leaves, key=lambda leaf: (len(values_by_path[leaf[0]]), -len(leaf[0])))
+                self.index[path][value].append(key)
+            else:
+                self.unindexed.append(key)
+
+def _match_index_value(value):
+    return value is None or isinstance(value, (bool, float, int, str))
+
+def _match_index_leaves(match, path):
+    """
+    Generate (path, value) for scalar values in match definition.
+    """
+    for k, v in match.items():
+        if isinstance(v, dict):
+            yield from _match_index_leaves(v, path + (k,))
+        elif _match_index_value(v):
+            yield path + (k,), v
+
+class TTLCache(object):
+    """
+    Thread-safe cache of values which expire after ttl seconds. Cached values
+    may be None to record that a lookup found nothing.
+    """
+    def __init__(self, name, ttl):
+        self.name = name
+        self.ttl = ttl
+        self.items = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key):
+        """
+        Return tuple of whether key was found and the cached value.
+        """
+        with self.lock:
+            item = self.items.get(key)
+            if item and item[0] > time.monotonic():
+                self.hits += 1
+                return True, item[1]
+            if item:
+                del self.items[key]
+            self.misses += 1
+            return False, None
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = (time.monotonic() + self.ttl, value)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+class TemplatePlan(object):
+    """
+    Plan for processing template strings within a data structure. Paths to
+    strings which need rendering are found once so that processing renders
+    only those strings and copies only the containers along their paths.
+    Other subtrees of the result are shared with the source template and so
+    must not be modified.
+    """
+    def __init__(self, template, template_style):
+        self.template = template
+        self.template_style = template_style
+        self.path_tree = _template_render_path_tree(template, template_style)
+
+    def process(self, variables):
+        if self.path_tree is False:
+            return self.template
+        return _template_plan_process(self.template, self.path_tree, self.template_style, variables)
+
+def _template_render_path_tree(template, template_style):
+    """
+    Return tree of keys leading to strings which need rendering, True for a
+    string which needs rendering, or False if nothing needs rendering.
+    """
+    if isinstance(template, dict):
+        items = template.items()
+    elif isinstance(template, list):
+        items = enumerate(template)
+    elif isinstance(template, str):
+        return jinja2needs_render(template, template_style)
+    else:
+        return False
+    tree = {}
+    for k, v in items:
+        subtree = _template_render_path_tree(v, template_style)
+        if subtree is not False:
+            tree[k] = subtree
+    return tree or False
+
+def _template_plan_process(template, path_tree, template_style, variables):
+    if path_tree is True:
+        return jinja2process(template, template_style, variables)
+    ret = copy.copy(template)
+    for k, subtree in path_tree.items():
+        ret[k] = _template_plan_process(template[k], subtree, template_style, variables)
+    return ret
+
+class TokenBucket(object):
+    """
+    Token bucket rate limiter allowing an average of rate acquisitions per
+    second with bursts of up to burst. A rate of zero disables rate limiting.
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.lock = threading.Lock()
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def acquire(self):
+        """
+        Wait for a token to be available, returns seconds spent waiting.
+        """
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def reserve(self):
+        """
+        Reserve a token without waiting, returns seconds the caller must wait
+        before using it.
+        """
+        if self.rate <= 0:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Reserve token, waiting for the balance to recover if negative
+            self.tokens -= 1
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
 jinja2envs = {
     'jinja2': jinja2.Environment(),
     'legacy': jinja2.Environment(
@@ -137,11 +512,30 @@ def dict_merge(dct, merge_dct):
     for k, v in merge_dct.items():
         if k in dct \
         and isinstance(dct[k], dict) \
-        and isinstance(merge_dct[k], collections.Mapping):
+        and isinstance(merge_dct[k], collections.abc.Mapping):
             dict_merge(dct[k], merge_dct[k])
         else:
             dct[k] = copy.deepcopy(merge_dct[k])
 
+def dict_merged(dct, merge_dct):
+    """ Copy-on-write version of dict_merge, returns the result of merging
+    ``merge_dct`` into ``dct`` without modifying either. Only dicts along the
+    merged paths are copied, all other values in the result are shared with
+    ``dct`` or ``merge_dct`` and so must not be modified.
+    :param dct: dict onto which the merge is executed
+    :param merge_dct: dct merged into dct
+    :return: merged dict
+    """
+    ret = dict(dct)
+    for k, v in merge_dct.items():
+        if k in dct \
+        and isinstance(dct[k], dict) \
+        and isinstance(v, collections.abc.Mapping):
+            ret[k] = dict_merged(dct[k], v)
+        else:
+            ret[k] = v
+    return ret
+
 def defaults_from_schema(schema):
     obj = {}
     for prop, property_schema in schema.get('properties', {}).items():
@@ -156,12 +550,74 @@ def defaults_from_schema(schema):
     if obj:
         return obj
 
+def _template_strip_ignored(template, path, ignore_re_list):
+    if isinstance(template, dict):
+        ret = {}
+        for k, v in template.items():
+            item_path = path + '/' + k.replace('~', '~0').replace('/', '~1')
+            if isinstance(v, (dict, list)):
+                ret[k] = _template_strip_ignored(v, item_path, ignore_re_list)
+            elif not any(ignore_re.match(item_path) for ignore_re in ignore_re_list):
+                ret[k] = v
+        return ret
+    elif isinstance(template, list):
+        ret = []
+        for i, v in enumerate(template):
+            item_path = path + '/' + str(i)
+            if isinstance(v, (dict, list)):
+                ret.append(_template_strip_ignored(v, item_path, ignore_re_list))
+            elif any(ignore_re.match(item_path) for ignore_re in ignore_re_list):
+                # Placeholder to preserve list length and item positions
+                ret.append(None)
+            else:
+                ret.append(v)
+        return ret
+    else:
+        return template
+
+def template_fingerprint(template, ignore_re_list=[]):
+    """
+    Return canonical hash for template. Scalar values at paths which match any
+    of the compiled regular expressions in ignore_re_list are excluded so that
+    templates which differ only in ignored values share a fingerprint.
+    """
+    if ignore_re_list:
+        template = _template_strip_ignored(template, '', ignore_re_list)
+    return hashlib.sha256(
+        json.dumps(template, sort_keys=True, separators=(',', ':')).encode('utf-8')
+    ).hexdigest()
+
+def jinja2needs_render(template, template_style):
+    """
+    Check if string must be rendered by Jinja2, false if rendering would
+    return the string unchanged.
+    """
+    jinja2env = jinja2envs.get(template_style)
+    return (
+        jinja2env.variable_start_string in template or
+        jinja2env.block_start_string in template or
+        jinja2env.comment_start_string in template or
+        # Jinja2 normalizes newlines and strips a single trailing newline
+        '\r' in template or
+        template.endswith('\n')
+    )
+
+@functools.lru_cache(maxsize=1024)
+def jinja2template(template_style, template):
+    """
+    Return compiled template, compiled templates are cached by template style
+    and source. Cache statistics are available from jinja2template.cache_info().
+    """
+    jinja2env = jinja2envs.get(template_style)
+    return jinja2env.from_string(template)
+
 def jinja2process(template, template_style, variables):
+    if not jinja2needs_render(template, template_style):
+        return template
     variables = copy.copy(variables)
     variables['timedelta'] = TimeDelta()
     variables['timestamp'] = TimeStamp()
-    jinja2env = jinja2envs.get(template_style)
-    j2template = jinja2env.from_string(template)
+    j2template = jinja2template(template_style, template)
     return j2template.render(variables)
 
 def recursive_process_template_strings(template, template_style, variables={}):
@@ -1,6 +1,10 @@
 #!/usr/bin/env python
 
+import asyncio
+import calendar
+import concurrent.futures
 import copy
+import functools
 import gpte.kubeoperative
 import json
 import kopf
@@ -14,44 +18,243 @@ import threading
 import time
 
 from datetime import datetime, timedelta
-from gpte.util import TimeDelta, TimeStamp, defaults_from_schema, dict_merge, recursive_process_template_strings
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from gpte.util import CoalescingQueue, ExpiryScheduler, LockTable, MatchIndex, TTLCache, TemplatePlan, TimeDelta, TimeStamp, TokenBucket, defaults_from_schema, dict_merge, dict_merged, jinja2template, template_fingerprint
 
+claim_resource_status_delay = float(os.environ.get('CLAIM_RESOURCE_STATUS_DELAY', 1))
+claim_resource_status_workers = int(os.environ.get('CLAIM_RESOURCE_STATUS_WORKERS', 4))
 logging_level = os.environ.get('LOGGING_LEVEL', 'INFO')
+metrics_port = int(os.environ.get('METRICS_PORT', 8000))
 manage_handles_interval = int(os.environ.get('MANAGE_HANDLES_INTERVAL', 60))
+manage_handles_page_size = int(os.environ.get('MANAGE_HANDLES_PAGE_SIZE', 100))
+manage_handles_workers = int(os.environ.get('MANAGE_HANDLES_WORKERS', 4))
+pool_handle_create_parallelism = int(os.environ.get('POOL_HANDLE_CREATE_PARALLELISM', 5))
+pool_handle_create_rate = float(os.environ.get('POOL_HANDLE_CREATE_RATE', 5))
+requester_cache_ttl = int(os.environ.get('REQUESTER_CACHE_TTL', 600))
+requester_cache_watch = os.environ.get('REQUESTER_CACHE_WATCH', 'false').lower() == 'true'
+resource_watch_cluster_scoped = os.environ.get('RESOURCE_WATCH_CLUSTER_SCOPED', 'false').lower() == 'true'
 
 @kopf.on.startup()
-def configure(settings: kopf.OperatorSettings, **_):
+async def configure(settings: kopf.OperatorSettings, **_):
+    global providers_loaded
     # Disable scanning for CustomResourceDefinitions
     settings.scanning.disabled = True
+    # Synchronous code in other threads runs coroutines on the operator loop
+    ako.loop = asyncio.get_running_loop()
+    providers_loaded = asyncio.Event()
 
 ko = gpte.kubeoperative.KubeOperative(
     operator_domain = os.environ.get('OPERATOR_DOMAIN', 'poolboy.gpte.redhat.com')
 )
+ako = gpte.kubeoperative.AsyncKubeOperative(ko)
 providers = {}
-provider_init_delay = int(os.environ.get('PROVIDER_INIT_DELAY', 10))
-start_time = time.time()
+resource_handle_namespace_label = ko.operator_domain + '/resource-handle-namespace'
+resource_cache = gpte.kubeoperative.ResourceCache(
+    enabled = os.environ.get('RESOURCE_CACHE_ENABLED', 'true').lower() == 'true'
+)
 
-pool_management_lock = threading.Lock()
-manage_handle_lock = threading.Lock()
-manage_handle_locks = {}
+# Requester lookups are cached with TTL, optionally invalidated by watch events
+namespace_requester_cache = TTLCache('namespace-requester', requester_cache_ttl)
+openshift_identity_cache = TTLCache('openshift-identity', requester_cache_ttl)
+openshift_user_cache = TTLCache('openshift-user', requester_cache_ttl)
+
+# Resource events are collapsed per claim resource to propagate only the latest state
+claim_resource_status_queue = CoalescingQueue(
+    'claim_resource_status',
+    lambda key, event: manage_claim_resource_event(key, event),
+    delay = claim_resource_status_delay,
+    workers = claim_resource_status_workers,
+)
+
+lifespan_end_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers = manage_handles_workers,
+    thread_name_prefix = 'lifespan_end',
+)
+lifespan_end_scheduler = ExpiryScheduler(
+    'lifespan_end',
+    lambda handle_name: lifespan_end_executor.submit(manage_handle_lifespan_end, handle_name)
+)
+
+# Set once ResourceProviders are loaded at startup, handlers wait for providers.
+# Created at startup so that the event belongs to the operator loop.
+providers_loaded = None
+
+manage_pool_locks = LockTable()
+pool_handles_in_flight = {}
+pool_handle_create_tasks = set()
+pool_handle_create_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers = pool_handle_create_parallelism,
+    thread_name_prefix = 'create_handle_for_pool',
+)
+pool_handle_create_rate_limiter = TokenBucket(pool_handle_create_rate, pool_handle_create_parallelism)
+manage_handle_locks = LockTable()
+
+# Patch restrictions for ResourceClaim initialization
+claim_init_update_filters = gpte.kubeoperative.UpdateFilters([
+    # Update anything in metadata on init
+    { 'pathMatch': '/metadata/.*', 'allowedOps': ['add', 'replace'] },
+    # Update anything in resources[].provider
+    { 'pathMatch': '/spec/resources/[0-9]+/provider(/.*)?', 'allowedOps': ['add', 'replace'] },
+    # Only process default overrides in template
+    { 'pathMatch': '/spec/resources/[0-9]+/template(/.*)?', 'allowedOps': ['add'] },
+])
+
+# Index of unbound ResourceHandles maintained from watch events for claim matching
+unbound_handle_index_lock = threading.Lock()
+unbound_handles = {}
+unbound_handles_by_fingerprints = {}
+unbound_handles_by_pool = {}
+unbound_handles_by_providers = {}
+unbound_handle_fingerprints = {}
+unbound_handle_versions = {}
+
+# Prometheus metrics
+api_calls = prometheus_client.Counter(
+    'poolboy_api_calls',
+    'Kubernetes API calls by verb and resource',
+    ['verb', 'resource']
+)
+api_connection_wait = prometheus_client.Histogram(
+    'poolboy_api_connection_wait_seconds',
+    'Seconds API calls waited for a connection from the connection pool',
+    buckets = (0.001, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30),
+)
+api_rate_limit_wait = prometheus_client.Histogram(
+    'poolboy_api_rate_limit_wait_seconds',
+    'Seconds API calls waited on the client side rate limiter',
+    ['budget'],
+    buckets = (0, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30),
+)
+manage_handles_pass_duration = prometheus_client.Gauge(
+    'poolboy_manage_handles_pass_duration_seconds',
+    'Duration of last periodic pass to manage all ResourceHandles'
+)
+operation_duration = prometheus_client.Histogram(
+    'poolboy_operation_duration_seconds',
+    'Duration of operator operations',
+    ['operation']
+)
+requester_cache_requests = prometheus_client.Counter(
+    'poolboy_requester_cache_requests',
+    'Requests to caches for requester namespace, user, and identity lookups',
+    ['cache', 'result']
+)
+
+def time_async(metric):
+    """
+    Decorator to observe duration of coroutine in metric, prometheus_client
+    time() decorator only supports functions.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with metric.time():
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+template_render_duration = operation_duration.labels(operation='render_template')
+
+class OperatorMetricsCollector(object):
+    """
+    Report metrics collected from operator state at scrape time.
+    """
+    def collect(self):
+        yield GaugeMetricFamily(
+            'poolboy_claim_resource_status_queue_depth', 'Claim resource events waiting for status propagation',
+            value = len(claim_resource_status_queue)
+        )
+        yield CounterMetricFamily(
+            'poolboy_claim_resource_status_events', 'Claim resource events queued for status propagation',
+            value = claim_resource_status_queue.puts
+        )
+        yield CounterMetricFamily(
+            'poolboy_claim_resource_status_events_coalesced', 'Claim resource events replaced by a later event before propagation',
+            value = claim_resource_status_queue.coalesced
+        )
+        yield GaugeMetricFamily(
+            'poolboy_claim_resource_status_coalescing_ratio', 'Fraction of claim resource events replaced by a later event',
+            value = claim_resource_status_queue.coalesced / claim_resource_status_queue.puts if claim_resource_status_queue.puts else 0
+        )
+        cache_info = jinja2template.cache_info()
+        yield CounterMetricFamily(
+            'poolboy_jinja2_template_cache_hits', 'Compiled Jinja2 template cache hits',
+            value = cache_info.hits
+        )
+        yield CounterMetricFamily(
+            'poolboy_jinja2_template_cache_misses', 'Compiled Jinja2 template cache misses',
+            value = cache_info.misses
+        )
+        yield GaugeMetricFamily(
+            'poolboy_jinja2_template_cache_size', 'Number of compiled Jinja2 templates in cache',
+            value = cache_info.currsize
+        )
+        yield GaugeMetricFamily(
+            'poolboy_manage_handle_locks', 'Number of entries in ResourceHandle lock table',
+            value = len(manage_handle_locks)
+        )
+        yield GaugeMetricFamily(
+            'poolboy_watches', 'Number of resource watches running in the watch multiplexer',
+            value = ko.watch_multiplexer.task_count
+        )
+        watch_errors = CounterMetricFamily(
+            'poolboy_watch_errors', 'Errors in resource watch', labels = ['watch']
+        )
+        watch_events = CounterMetricFamily(
+            'poolboy_watch_events', 'Events received by resource watch', labels = ['watch']
+        )
+        watch_relists = CounterMetricFamily(
+            'poolboy_watch_relists', 'Full relists of resources for resource watch', labels = ['watch']
+        )
+        watch_restarts = CounterMetricFamily(
+            'poolboy_watch_restarts', 'Restarts of resource watch', labels = ['watch']
+        )
+        for watcher in list(ko.watchers.values()):
+            watch_errors.add_metric([watcher.name], watcher.errors)
+            watch_events.add_metric([watcher.name], watcher.events)
+            watch_relists.add_metric([watcher.name], watcher.relists)
+            watch_restarts.add_metric([watcher.name], watcher.restarts)
+        yield watch_errors
+        yield watch_events
+        yield watch_relists
+        yield watch_restarts
+        unbound_handles_gauge = GaugeMetricFamily(
+            'poolboy_unbound_handles', 'Number of unbound ResourceHandles by ResourcePool',
+            labels = ['pool']
+        )
+        with unbound_handle_index_lock:
+            for pool_name, handle_names in unbound_handles_by_pool.items():
+                unbound_handles_gauge.add_metric([pool_name], len(handle_names))
+        yield unbound_handles_gauge
+
+prometheus_client.REGISTRY.register(OperatorMetricsCollector())
+ko.api_call_hooks.append(
+    lambda verb, resource: api_calls.labels(verb=verb, resource=resource).inc()
+)
+ko.api_connection_wait_hooks.append(api_connection_wait.observe)
+ko.api_rate_limit_hooks.append(
+    lambda budget, waited: api_rate_limit_wait.labels(budget=budget).observe(waited)
+)
 
 def add_finalizer_to_handle(handle, logger):
     handle_meta = handle['metadata']
     handle_namespace = handle_meta['namespace']
     handle_name = handle_meta['name']
-    ko.custom_objects_api.patch_namespaced_custom_object(
+    handle = ko.custom_objects_api.patch_namespaced_custom_object(
         ko.operator_domain, ko.version, handle_namespace, 'resourcehandles', handle_name,
         { 'metadata': { 'finalizers': [ko.operator_domain] } }
     )
+    resource_cache.put('resourcehandles', handle)
 
 def add_finalizer_to_pool(pool, logger):
     pool_meta = pool['metadata']
     pool_namespace = pool_meta['namespace']
     pool_name = pool_meta['name']
-    ko.custom_objects_api.patch_namespaced_custom_object(
+    pool = ko.custom_objects_api.patch_namespaced_custom_object(
         ko.operator_domain, ko.version, pool_namespace, 'resourcepools', pool_name,
         { 'metadata': { 'finalizers': [ko.operator_domain] } }
     )
+    resource_cache.put('resourcepools', pool)
 
 def bind_handle_to_claim(handle, claim, logger):
     claim_meta = claim['metadata']
@@ -61,7 +264,6 @@ def bind_handle_to_claim(handle, claim, logger):
     handle_meta = handle['metadata']
     handle_name = handle_meta['name']
     handle_spec = handle['spec']
-    pool_ref = handle_spec.get('resourcePool')
 
     # Check if ResourceClaim includes requested lifespan end
     lifespan_end = claim_spec.get('lifespan', {}).get('end')
@@ -140,17 +342,18 @@ def bind_handle_to_claim(handle, claim, logger):
         handle = ko.custom_objects_api.replace_namespaced_custom_object(
             ko.operator_domain, ko.version, ko.operator_namespace, 'resourcehandles', handle_name, handle
         )
+        resource_cache.put('resourcehandles', handle)
+        # Bound handle is not indexed again by earlier events
+        unindex_handle(handle_name, handle['metadata']['resourceVersion'])
     except kubernetes.client.rest.ApiException as e:
         if e.status == 404:
+            unindex_handle(handle_name)
             raise kopf.TemporaryError(f"ResourceClaim {claim_name} failed to bind ResourceHandle {handle_name}, not found", delay=1)
         elif e.status == 409:
             raise kopf.TemporaryError(f"ResourceClaim {claim_name} failed to bind ResourceHandle {handle_name}, conflict", delay=1)
         else:
             raise
 
-    if pool_ref:
-        manage_pool_by_ref(pool_ref, logger)
-
     return handle
 
 def check_create_disabled(claim, logger):
@@ -342,58 +545,131 @@ def delete_unbound_handles_for_pool(pool, logger):
              ko.operator_domain, ko.version, ko.operator_namespace, 'resourcehandles', handle_name
          )
 
-def get_claim_for_handle(handle, logger):
+async def get_claim_for_handle(handle, logger):
     if 'resourceClaim' not in handle['spec']:
         return None
 
     claim_ref = handle['spec']['resourceClaim']
     claim_name = claim_ref['name']
     claim_namespace = claim_ref['namespace']
+    return await get_cached_resource_async('resourceclaims', claim_namespace, claim_name)
+
+def get_cached_resource(plural, namespace, name):
+    """
+    Get poolboy custom resource from the resource cache, falling back to a
+    request to the API if not cached. Returns None if the resource is not found.
+    """
+    resource = resource_cache.get(plural, namespace, name)
+    if resource:
+        return resource
+    try:
+        resource = ko.custom_objects_api.get_namespaced_custom_object(
+            ko.operator_domain, ko.version, namespace, plural, name
+        )
+    except kubernetes.client.rest.ApiException as e:
+        if e.status == 404:
+            return None
+        else:
+            raise
+    resource_cache.put(plural, resource)
+    return resource
+
+async def get_cached_resource_async(plural, namespace, name):
+    """
+    Asyncio variant of get_cached_resource.
+    """
+    resource = resource_cache.get(plural, namespace, name)
+    if resource:
+        return resource
     try:
-        return ko.custom_objects_api.get_namespaced_custom_object(
-            ko.operator_domain, ko.version, claim_namespace,
-            'resourceclaims', claim_name
+        resource = await ako.get_namespaced_custom_object(
+            ko.operator_domain, ko.version, namespace, plural, name
         )
     except kubernetes.client.rest.ApiException as e:
         if e.status == 404:
             return None
         else:
             raise
+    resource_cache.put(plural, resource)
+    return resource
 
-def get_requester_from_namespace(namespace):
-    resource_claim_namespace = ko.core_v1_api.read_namespace(namespace)
-    requester_user_name = resource_claim_namespace.metadata.annotations.get(
+async def get_cached_lookup_async(cache, key, lookup):
+    """
+    Return value from TTLCache or await lookup to get the value and cache it.
+    """
+    found, value = cache.get(key)
+    requester_cache_requests.labels(cache=cache.name, result='hit' if found else 'miss').inc()
+    if found:
+        return value
+    value = await lookup(key)
+    cache.put(key, value)
+    return value
+
+async def get_namespace_requester_async(namespace):
+    resource_claim_namespace = await ako.request('GET', '/api/v1/namespaces/' + namespace)
+    return (resource_claim_namespace['metadata'].get('annotations') or {}).get(
         'openshift.io/requester', None
     )
-    if not requester_user_name:
-        return None, None
 
-    requester_user = requester_identity = None
+async def get_openshift_identity_async(name):
     try:
-        requester_user = ko.custom_objects_api.get_cluster_custom_object(
-            'user.openshift.io', 'v1', 'users', requester_user_name
-        )
-        if requester_user.get('identities', None):
-            requester_identity = ko.custom_objects_api.get_cluster_custom_object(
-                'user.openshift.io', 'v1', 'identities', requester_user['identities'][0]
-            )
+        return await ako.request('GET', '/apis/user.openshift.io/v1/identities/' + name)
     except kubernetes.client.rest.ApiException as e:
         if e.status not in (404, 422):
             raise
 
-    return requester_identity, requester_user
-
-def get_resource_handle(name, logger):
+async def get_openshift_user_async(name):
     try:
-        return ko.custom_objects_api.get_namespaced_custom_object(
-            ko.operator_domain, ko.version, ko.operator_namespace, 'resourcehandles', name
-        )
+        return await ako.request('GET', '/apis/user.openshift.io/v1/users/' + name)
     except kubernetes.client.rest.ApiException as e:
-        if e.status == 404:
-            return None
-        else:
+        if e.status not in (404, 422):
             raise
 
+async def get_requester_from_namespace_async(namespace):
+    requester_user_name = await get_cached_lookup_async(
+        namespace_requester_cache, namespace, get_namespace_requester_async
+    )
+    if not requester_user_name:
+        return None, None
+
+    requester_identity = None
+    requester_user = await get_cached_lookup_async(
+        openshift_user_cache, requester_user_name, get_openshift_user_async
+    )
+    if requester_user and requester_user.get('identities', None):
+        requester_identity = await get_cached_lookup_async(
+            openshift_identity_cache, requester_user['identities'][0], get_openshift_identity_async
+        )
+
+    return requester_identity, requester_user
+
+def get_resource_handle(name, logger):
+    return get_cached_resource('resourcehandles', ko.operator_namespace, name)
+
+def get_unbound_handle_candidates(pool_name=None, provider_names=None, fingerprints=None):
+    """
+    Return unbound ResourceHandles from the index, optionally restricted to a
+    ResourcePool name, to a tuple of ResourceProvider names, and to a tuple of
+    resource template fingerprints.
+    """
+    with unbound_handle_index_lock:
+        handle_names = None
+        for index, key in (
+            (unbound_handles_by_pool, pool_name),
+            (unbound_handles_by_providers, provider_names),
+            (unbound_handles_by_fingerprints, fingerprints),
+        ):
+            if not key:
+                continue
+            key_handle_names = index.get(key, set())
+            if handle_names is None:
+                handle_names = key_handle_names
+            else:
+                handle_names = handle_names & key_handle_names
+        if handle_names is None:
+            return list(unbound_handles.values())
+        return [unbound_handles[handle_name] for handle_name in handle_names]
+
 def get_unbound_handles_for_pool(pool_name, logger):
     return ko.custom_objects_api.list_namespaced_custom_object(
         ko.operator_domain, ko.version, ko.operator_namespace, 'resourcehandles',
@@ -402,8 +678,110 @@ def get_unbound_handles_for_pool(pool_name, logger):
         )
     ).get('items', [])
 
+def handle_resource_fingerprints(handle):
+    """
+    Return tuple of resource template fingerprints for ResourceHandle or None if
+    any ResourceProvider for the handle is not known.
+    """
+    fingerprints = []
+    for handle_resource in handle['spec'].get('resources', []):
+        provider = ResourceProvider.providers.get(handle_resource['provider']['name'])
+        if not provider:
+            return None
+        fingerprints.append(provider.template_fingerprint(handle_resource.get('template', {})))
+    return tuple(fingerprints)
+
+def index_unbound_handle(handle):
+    """
+    Add, update, or remove ResourceHandle in the unbound handle index. The
+    index keeps its own copy of the handle and ignores handles with a
+    resourceVersion that is not newer than the last indexed for the handle.
+    """
+    handle_meta = handle['metadata']
+    handle_name = handle_meta['name']
+    resource_version = handle_meta.get('resourceVersion', '')
+    labels = handle_meta.get('labels') or {}
+    if ko.operator_domain + '/resource-claim-name' in labels \
+    or 'resourceClaim' in handle['spec'] \
+    or 'deletionTimestamp' in handle_meta:
+        handle = None
+        fingerprints = None
+    else:
+        handle = copy.deepcopy(handle)
+        fingerprints = handle_resource_fingerprints(handle)
+
+    with unbound_handle_index_lock:
+        seen_version = unbound_handle_versions.get(handle_name)
+        if seen_version and not gpte.kubeoperative.is_newer_resource_version(resource_version, seen_version):
+            return
+        unbound_handle_versions[handle_name] = resource_version
+        current = unbound_handles.get(handle_name)
+        if current:
+            _unindex_handle(current)
+        if handle:
+            _index_handle(handle, fingerprints)
+
+def _index_handle(handle, fingerprints):
+    """
+    Add ResourceHandle to index, must be called with unbound_handle_index_lock held.
+    """
+    handle_meta = handle['metadata']
+    handle_name = handle_meta['name']
+    pool_name = (handle_meta.get('labels') or {}).get(ko.operator_domain + '/resource-pool-name')
+    provider_names = tuple(
+        resource['provider']['name'] for resource in handle['spec'].get('resources', [])
+    )
+    unbound_handles[handle_name] = handle
+    if pool_name:
+        unbound_handles_by_pool.setdefault(pool_name, set()).add(handle_name)
+    unbound_handles_by_providers.setdefault(provider_names, set()).add(handle_name)
+    if fingerprints:
+        unbound_handle_fingerprints[handle_name] = fingerprints
+        unbound_handles_by_fingerprints.setdefault(fingerprints, set()).add(handle_name)
+
+def load_resource_providers(logger):
+    """
+    Load ResourceProviders from the API, later maintained by watch events.
+    """
+    _continue = None
+    while True:
+        kwargs = { "limit": 100 }
+        if _continue:
+            kwargs['_continue'] = _continue
+        resp = ko.custom_objects_api.list_namespaced_custom_object(
+            ko.operator_domain, ko.version, ko.operator_namespace, 'resourceproviders',
+            **kwargs
+        )
+        for provider in resp.get('items', []):
+            ResourceProvider.manage_provider(provider)
+        _continue = resp['metadata'].get('continue')
+        if not _continue:
+            break
+    logger.info('Loaded %d ResourceProviders', len(ResourceProvider.providers))
+
+def load_unbound_handle_index(logger):
+    """
+    Populate unbound handle index from the API, later maintained by watch events.
+    """
+    _continue = None
+    while True:
+        kwargs = { "limit": 100 }
+        if _continue:
+            kwargs['_continue'] = _continue
+        resp = ko.custom_objects_api.list_namespaced_custom_object(
+            ko.operator_domain, ko.version, ko.operator_namespace, 'resourcehandles',
+            label_selector='!{0}/resource-claim-name'.format(ko.operator_domain),
+            **kwargs
+        )
+        for handle in resp.get('items', []):
+            index_unbound_handle(handle)
+        _continue = resp['metadata'].get('continue')
+        if not _continue:
+            break
+    logger.info('Loaded %d unbound ResourceHandles', len(unbound_handles))
+
 def log_claim_extra(claim, extra={}):
-    ret = copy.deepcopy(extra)
+    ret = dict(extra)
     ret['ResourceClaim'] = {
         'name': claim['metadata']['name'],
         'namespace': claim['metadata']['namespace'],
@@ -424,7 +802,7 @@ def log_claim_error(claim, logger, msg, extra={}):
     # FIXME - Create event for claim
 
 def log_handle_extra(handle, extra={}):
-    ret = copy.deepcopy(extra)
+    ret = dict(extra)
     ret['ResourceHandle'] = {
         'name': handle['metadata']['name'],
         'uid': handle['metadata']['uid'],
@@ -444,7 +822,7 @@ def log_handle_error(handle, logger, msg, extra={}):
     # FIXME - Create event for handle
 
 def log_pool_extra(pool, extra={}):
-    ret = copy.deepcopy(extra)
+    ret = dict(extra)
     ret['ResourceHandle'] = {
         'name': pool['metadata']['name'],
         'uid': pool['metadata']['uid'],
@@ -463,35 +841,48 @@ def log_pool_error(pool, logger, msg, extra={}):
     logger.error(msg, extra=log_pool_extra(pool, extra))
     # FIXME - Create event for pool
 
-def manage_claim(claim, logger):
+@time_async(operation_duration.labels(operation='manage_claim'))
+async def manage_claim_async(claim, logger):
     """
     Called on each ResourceClaim event
     """
     claim_status = claim.get('status', None)
     if not claim_status:
-        manage_claim_create(claim, logger)
+        # Provider match and handle bind happen once per claim, run in thread
+        claim = await run_in_executor(manage_claim_create, claim, logger)
+        if claim:
+            await manage_claim_init_async(claim, logger)
         return
 
     annotations = claim['metadata'].get('annotations', {})
     if ko.operator_domain + '/resource-claim-init-timestamp' not in annotations:
-        manage_claim_init(claim, logger)
+        await manage_claim_init_async(claim, logger)
     elif validate_claim(claim, logger):
         if 'resourceHandle' not in claim_status:
-            manage_claim_bind(claim, logger)
+            claim, pool_ref = await run_in_executor(manage_claim_bind, claim, logger)
+            if pool_ref:
+                # Binding an unclaimed handle from a pool may require replacement
+                await manage_pool_by_ref(pool_ref, logger)
+            await manage_claim_async(claim, logger)
         else:
-            manage_claim_update(claim, logger)
+            await manage_claim_update(claim, logger)
 
 def manage_claim_bind(claim, logger):
     """
     Called on claim event if ResourceClaim is not bound to a ResourceHandle
+
+    Returns the updated claim and reference to the ResourcePool of a bound
+    pool handle, if any, for management by the caller on the event loop.
     """
     claim_meta = claim['metadata']
     claim_name = claim_meta['name']
     claim_namespace = claim_meta['namespace']
 
+    pool_ref = None
     handle = match_handle_to_claim(claim, logger)
     if handle:
         handle = bind_handle_to_claim(handle, claim, logger)
+        pool_ref = handle['spec'].get('resourcePool')
     elif check_create_disabled(claim, logger):
         raise kopf.TemporaryError(f"ResourceClaim {claim_name} in {claim_namespace} cannot bind ResourceHandle and create is disabled for ResourceProvider", delay=30)
     else:
@@ -523,6 +914,7 @@ def manage_claim_bind(claim, logger):
             'status': status
         }
     )
+    resource_cache.put('resourceclaims', claim)
 
     log_claim_event(
         claim, logger,
@@ -535,14 +927,14 @@ def manage_claim_bind(claim, logger):
         }
     )
 
-    manage_claim(claim, logger)
+    return claim, pool_ref
 
 def manage_claim_create(claim, logger):
     """
     Called on ch claim event if the claim does not have a status
     This method will attempt to match ResourceProviders to each resource
     for the claim and set the names of the resource providers in the
-    status.
+    status. Returns the updated claim for initialization by the caller.
     """
     claim_meta = claim['metadata']
     claim_spec = claim['spec']
@@ -580,7 +972,8 @@ def manage_claim_create(claim, logger):
             }
         }
     )
-    manage_claim_init(claim, logger)
+    resource_cache.put('resourceclaims', claim)
+    return claim
 
 def manage_claim_deleted(claim, logger):
     claim_meta = claim['metadata']
@@ -601,7 +994,7 @@ def manage_claim_deleted(claim, logger):
         )
         delete_resource_handle(handle_name, logger)
 
-def manage_claim_init(claim, logger):
+async def manage_claim_init_async(claim, logger):
     """
     Called after claim has resources matched to providers but
     resource-claim-init-timestamp annotation is not yet set.
@@ -636,26 +1029,17 @@ def manage_claim_init(claim, logger):
             logger.warning('ResourceClaim has more resources in spec than resourceProviders in status!')
             return
 
-    ko.patch_resource(
-        claim, update, [
-            # Update anything in metadata on init
-            { 'pathMatch': '/metadata/.*', 'allowedOps': ['add', 'replace'] },
-            # Update anything in resources[].provider
-            { 'pathMatch': '/spec/resources/[0-9]+/provider(/.*)?', 'allowedOps': ['add', 'replace'] },
-            # Only process default overrides in template
-            { 'pathMatch': '/spec/resources/[0-9]+/template(/.*)?', 'allowedOps': ['add'] },
-        ]
-    )
+    claim, changed = await ako.patch_resource(claim, update, claim_init_update_filters)
+    if changed:
+        resource_cache.put('resourceclaims', claim)
 
 def manage_claim_resource_delete(claim_namespace, claim_name, resource, resource_index, logger):
     resource_kind = resource['kind']
     resource_meta = resource['metadata']
     resource_name = resource_meta['name']
     resource_namespace = resource_meta.get('namespace', None)
-    try:
-        claim = ko.custom_objects_api.get_namespaced_custom_object(
-            ko.operator_domain, ko.version, claim_namespace, 'resourceclaims', claim_name
-        )
+
+    def update_state(claim, state):
         if resource_namespace:
             logger.info('ResourceClaim {} in {} lost resource {} {} in {}'.format(
                 claim_name, claim_namespace, resource_kind, resource_name, resource_namespace
@@ -664,22 +1048,23 @@ def manage_claim_resource_delete(claim_namespace, claim_name, resource, resource
             logger.info('ResourceClaim {} in {} lost resource {} {}'.format(
                 claim_name, claim_namespace, resource_kind, resource_name
             ))
-        status_resources = claim['status']['resources']
-        status_resource = status_resources[resource_index].get('state', None)
-
-        if status_resource \
-        and status_resource['metadata']['name'] == resource_name \
-        and status_resource['metadata']['namespace'] == resource_namespace:
-            status_resources[resource_index]['state'] = resource
-            ko.custom_objects_api.patch_namespaced_custom_object_status(
-                ko.operator_domain, ko.version, claim_namespace, 'resourceclaims', claim_name,
-                { 'status': { 'resources': status_resources } }
-            )
-    except (IndexError, KeyError):
-        pass
-    except kubernetes.client.rest.ApiException as e:
-        if e.status != 404:
-            raise
+        if state \
+        and state['metadata']['name'] == resource_name \
+        and state['metadata']['namespace'] == resource_namespace:
+            return resource
+
+    update_claim_resource_state(claim_namespace, claim_name, resource_index, update_state, logger)
+
+def manage_claim_resource_event(key, event):
+    """
+    Propagate latest resource event for a claim resource to the ResourceClaim status.
+    """
+    claim_namespace, claim_name, resource_index = key
+    event_type, resource, logger = event
+    if event_type == 'DELETED':
+        manage_claim_resource_delete(claim_namespace, claim_name, resource, resource_index, logger)
+    else:
+        manage_claim_resource_update(claim_namespace, claim_name, resource, resource_index, logger)
 
 def manage_claim_resource_update(claim_namespace, claim_name, resource, resource_index, logger):
     resource_kind = resource['kind']
@@ -705,119 +1090,131 @@ def manage_claim_resource_update(claim_namespace, claim_name, resource, resource
         },
     )
 
-    try:
-        claim = ko.custom_objects_api.get_namespaced_custom_object(
-            ko.operator_domain, ko.version, claim_namespace, 'resourceclaims', claim_name
-        )
-        status_resources = claim['status']['resources']
-        status_resource = status_resources[resource_index].get('state', None)
-
-        if not status_resource or (
-            status_resource['metadata']['name'] == resource_name and
-            status_resource['metadata']['namespace'] == resource_namespace and
-            status_resource != resource
+    def update_state(claim, state):
+        if not state or (
+            state['metadata']['name'] == resource_name and
+            state['metadata']['namespace'] == resource_namespace and
+            state != resource
         ):
-            status_resources[resource_index]['state'] = resource
-            ko.custom_objects_api.patch_namespaced_custom_object_status(
-                ko.operator_domain, ko.version, claim_namespace, 'resourceclaims', claim_name,
-                { 'status': { 'resources': status_resources } }
-            )
-    except (IndexError, KeyError):
-        pass
-    except kubernetes.client.rest.ApiException as e:
-        if e.status == 404:
-            logger.info('ResourceClaim %s in %s not found', claim_name, claim_namespace)
-        else:
-            raise
+            return resource
+
+    update_claim_resource_state(claim_namespace, claim_name, resource_index, update_state, logger)
 
-def manage_claim_update(claim, logger):
+async def manage_claim_update(claim, logger, attempts=3):
     """
     Called on each claim event once ResourceClaim is bound to a ResourceHandle
 
     Claim has already been validated. Propagate changes from claim to handle.
+    The ResourceHandle is patched at the resourceVersion it was read at,
+    retrying with the latest ResourceHandle if it was changed concurrently.
     """
     handle_name = claim['status']['resourceHandle']['name']
-    resource_handle = get_resource_handle(handle_name, logger)
-    if not resource_handle:
-        log_claim_event(
-            claim, logger,
-            'ResourceHandle has been lost',
-            {
-                'ResourceHandle': {
-                    'name': handle_name,
-                },
-            }
-        )
-        return
+    for attempt in range(attempts):
+        if attempt == 0:
+            resource_handle = await get_cached_resource_async('resourcehandles', ko.operator_namespace, handle_name)
+        else:
+            try:
+                resource_handle = await ako.get_namespaced_custom_object(
+                    ko.operator_domain, ko.version, ko.operator_namespace, 'resourcehandles', handle_name
+                )
+                resource_cache.put('resourcehandles', resource_handle)
+            except kubernetes.client.rest.ApiException as e:
+                if e.status != 404:
+                    raise
+                resource_handle = None
+        if not resource_handle:
+            log_claim_event(
+                claim, logger,
+                'ResourceHandle has been lost',
+                {
+                    'ResourceHandle': {
+                        'name': handle_name,
+                    },
+                }
+            )
+            return
 
-    have_update = False
-    handle_resources = resource_handle['spec']['resources']
-    for i, claim_resource in enumerate(claim['spec']['resources']):
-        handle_resource = handle_resources[i]
-        if 'template' in claim_resource \
-        and handle_resource.get('template') != claim_resource['template']:
-            handle_resource['template'] = claim_resource['template']
-            have_update = True
-
-    lifespan_end = claim['spec'].get('lifespan', {}).get('end')
-    handle_lifespan_end = resource_handle['spec'].get('lifespan', {}).get('end')
-    if lifespan_end and lifespan_end != handle_lifespan_end:
-        lifespan_end = TimeStamp(lifespan_end)
-        maximum_lifespan_end, maximum_type = maximum_lifespan_end_for_handle(resource_handle, claim)
-        if maximum_lifespan_end:
-            if lifespan_end > maximum_lifespan_end:
-                lifespan_end = maximum_lifespan_end
-                log_claim_warning(
-                    claim, logger,
-                    'requested change to lifespan end {} exceeds {} for ResourceHandle {}'.format(
-                        lifespan_end, maximum_type, maximum_lifespan_end
+        have_update = False
+        handle_resources = resource_handle['spec']['resources']
+        for i, claim_resource in enumerate(claim['spec']['resources']):
+            handle_resource = handle_resources[i]
+            if 'template' in claim_resource \
+            and handle_resource.get('template') != claim_resource['template']:
+                handle_resource['template'] = claim_resource['template']
+                have_update = True
+
+        lifespan_end = claim['spec'].get('lifespan', {}).get('end')
+        handle_lifespan_end = resource_handle['spec'].get('lifespan', {}).get('end')
+        if lifespan_end and lifespan_end != handle_lifespan_end:
+            lifespan_end = TimeStamp(lifespan_end)
+            maximum_lifespan_end, maximum_type = maximum_lifespan_end_for_handle(resource_handle, claim)
+            if maximum_lifespan_end:
+                if lifespan_end > maximum_lifespan_end:
+                    lifespan_end = maximum_lifespan_end
+                    log_claim_warning(
+                        claim, logger,
+                        'requested change to lifespan end {} exceeds {} for ResourceHandle {}'.format(
+                            lifespan_end, maximum_type, maximum_lifespan_end
+                        )
                     )
-                )
-            if not handle_lifespan_end or lifespan_end != TimeStamp(handle_lifespan_end):
-                # Recheck for update after possible adjustment for maximum
+                if not handle_lifespan_end or lifespan_end != TimeStamp(handle_lifespan_end):
+                    # Recheck for update after possible adjustment for maximum
+                    have_update = True
+            else:
                 have_update = True
-        else:
-            have_update = True
 
-    if have_update:
-        patch = { 'spec': { 'resources': handle_resources } }
+        if not have_update:
+            return
+
+        patch = {
+            'metadata': { 'resourceVersion': resource_handle['metadata']['resourceVersion'] },
+            'spec': { 'resources': handle_resources },
+        }
         if lifespan_end:
             patch['spec']['lifespan'] = { 'end': str(lifespan_end) }
-        ko.custom_objects_api.patch_namespaced_custom_object(
-            ko.operator_domain, ko.version, ko.operator_namespace, 'resourcehandles', handle_name, patch
-        )
+        try:
+            resource_handle = await ako.patch_namespaced_custom_object(
+                ko.operator_domain, ko.version, ko.operator_namespace, 'resourcehandles', handle_name, patch
+            )
+            resource_cache.put('resourcehandles', resource_handle)
+            return
+        except kubernetes.client.rest.ApiException as e:
+            if e.status == 409 and attempt + 1 < attempts:
+                logger.info('ResourceHandle %s changed, retrying update from ResourceClaim', handle_name)
+                continue
+            raise
 
 def manage_handle(handle, logger):
+    """
+    Run manage_handle_async from a thread other than the event loop
+    """
+    ako.run(manage_handle_async(handle, logger))
+
+@time_async(operation_duration.labels(operation='manage_handle'))
+async def manage_handle_async(handle, logger):
     """
     Called on all ResourceHandle events except delete
     """
     handle_meta = handle['metadata']
     handle_spec = handle['spec']
     handle_name = handle_meta['name']
-    handle_lock = None
-
-    with manage_handle_lock:
-        handle_lock = manage_handle_locks.get(handle_name)
-        if not handle_lock:
-            handle_lock = threading.Lock()
-            manage_handle_locks[handle_name] = handle_lock
 
-    with handle_lock:
+    async with manage_handle_locks.lock(handle_name):
         if 'deletionTimestamp' in handle['metadata']:
-            manage_handle_pending_delete(handle, logger)
+            await run_in_executor(manage_handle_pending_delete, handle, logger)
             return
         elif 'finalizers' not in handle_meta:
-            add_finalizer_to_handle(handle, logger)
+            await run_in_executor(add_finalizer_to_handle, handle, logger)
             return
         elif 'resourceClaim' in handle_spec:
-            claim = get_claim_for_handle(handle, logger)
+            claim = await get_claim_for_handle(handle, logger)
             if claim:
                 handle_lifespan = handle_spec.get('lifespan')
                 if handle_lifespan:
                     set_claim_status_lifespan = { k: v for k, v in handle_lifespan.items() if k != 'default' }
                     claim_status_lifespan = claim.get('status', {}).get('lifespan')
                     if claim_status_lifespan != set_claim_status_lifespan:
-                        ko.custom_objects_api.patch_namespaced_custom_object_status(
+                        claim = await ako.patch_namespaced_custom_object_status(
                             ko.operator_domain, ko.version, claim['metadata']['namespace'],
                             'resourceclaims', claim['metadata']['name'],
                             {
@@ -826,6 +1223,7 @@ def manage_handle(handle, logger):
                                 }
                             }
                         )
+                        resource_cache.put('resourceclaims', claim)
             else:
                 logger.info(
                     'Propagating delete to ResourceHandle after discovering ResourceClaim deleted',
@@ -839,7 +1237,7 @@ def manage_handle(handle, logger):
                         }
                     }
                 )
-                delete_resource_handle(handle_name, logger)
+                await run_in_executor(delete_resource_handle, handle_name, logger)
                 return
         else:
             claim = None
@@ -859,7 +1257,7 @@ def manage_handle(handle, logger):
                             }
                         }
                     )
-                    delete_resource_claim(claim_namespace, claim_name, logger)
+                    await run_in_executor(delete_resource_claim, claim_namespace, claim_name, logger)
                 else:
                     logger.info(
                         'Delete ResourceHandle at end of lifespan',
@@ -869,11 +1267,12 @@ def manage_handle(handle, logger):
                             }
                         }
                     )
-                    delete_resource_handle(handle_name, logger)
+                    await run_in_executor(delete_resource_handle, handle_name, logger)
                 return
 
         providers = []
-        handle_resources = handle_spec['resources']
+        # Copy resources for references update, the event body is not changed
+        handle_resources = copy.deepcopy(handle_spec['resources'])
         for handle_resource in handle_resources:
             provider_name = handle_resource['provider']['name']
             providers.append(
@@ -888,10 +1287,10 @@ def manage_handle(handle, logger):
             if provider.resource_requires_claim and not claim:
                 continue
 
-            resource_definition = provider.resource_definition_from_template(
+            resource_definition = await provider.resource_definition_from_template(
                 handle, claim, i, logger
             )
-            start_resource_watch(resource_definition)
+            await start_resource_watch(resource_definition, reference=handle_name)
 
             resource_api_version = resource_definition['apiVersion']
             resource_kind = resource_definition['kind']
@@ -910,7 +1309,7 @@ def manage_handle(handle, logger):
                 have_handle_update = True
                 handle_resource['reference'] = reference
 
-            resource = ko.get_resource(
+            resource = await ako.get_resource(
                 api_version = resource_api_version,
                 kind = resource_kind,
                 name = resource_name,
@@ -918,36 +1317,66 @@ def manage_handle(handle, logger):
             )
 
             if resource:
-                provider.update_resource(handle, resource, resource_definition, logger)
+                await provider.update_resource(handle, resource, resource_definition, logger)
             else:
                 resources_to_create.append(resource_definition)
 
         if have_handle_update:
             try:
-                handle = ko.custom_objects_api.patch_namespaced_custom_object(
+                # Patch at the resourceVersion read so that concurrent changes
+                # to resources are not overwritten
+                handle = await ako.patch_namespaced_custom_object(
                     ko.operator_domain, ko.version, ko.operator_namespace, 'resourcehandles', handle_name,
-                    { 'spec': { 'resources': handle_resources } }
+                    {
+                        'metadata': { 'resourceVersion': handle_meta['resourceVersion'] },
+                        'spec': { 'resources': handle_resources },
+                    }
                 )
+                resource_cache.put('resourcehandles', handle)
             except kubernetes.client.rest.ApiException as e:
+                if e.status == 409:
+                    # Event for the changed ResourceHandle manages it again
+                    logger.info('ResourceHandle %s changed, skipping update', handle_name)
+                    return
                 if e.status != 404:
                     raise
 
         for resource_definition in resources_to_create:
             resource_definition['metadata']['annotations'][ko.operator_domain + '/resource-handle-version'] = \
                 handle['metadata']['resourceVersion']
-            ko.create_resource(resource_definition)
+            await ako.create_resource(resource_definition)
 
-def manage_handle_deleted(handle, logger):
+async def manage_handle_deleted(handle, logger):
     handle_meta = handle['metadata']
     handle_name = handle_meta['name']
     logger.info('ResourceHandle deleted')
 
+    # Stop resource watches no longer needed for any ResourceHandle
+    ko.remove_watcher_reference(handle_name)
+
     claim_ref = handle['spec'].get('resourceClaim')
     pool_ref = handle['spec'].get('resourcePool')
 
     # Delete of unclaimed handle from pool may require replacement
     if pool_ref and not claim_ref:
-        manage_pool_by_ref(pool_ref, logger)
+        await manage_pool_by_ref(pool_ref, logger)
+
+def manage_handle_lifespan_end(handle_name):
+    """
+    Called by lifespan end scheduler when ResourceHandle reaches end of lifespan.
+    """
+    logger = logging.getLogger('lifespan_end')
+    handle = get_resource_handle(handle_name, logger)
+    if not handle:
+        return
+    object_logger = kopf.LocalObjectLogger(
+        body = handle,
+        settings = kopf.OperatorSettings(),
+    )
+    try:
+        manage_handle(handle, object_logger)
+    except Exception as e:
+        object_logger.exception("Error managing handle at end of lifespan")
 
 def manage_handle_lost_resource(handle_name, resource, resource_index):
     try:
@@ -965,11 +1394,12 @@ def manage_handle_lost_resource(handle_name, resource, resource_index):
         and reference['namespace'] == resource['metadata']['namespace']:
             resources_update = [{} for i in range(resource_index)]
             resources_update[resource_index] = {'reference': None}
-            ko.custom_objects_api.patch_namespaced_custom_object(
+            handle = ko.custom_objects_api.patch_namespaced_custom_object(
                 ko.operator_domain, ko.version, ko.operator_namespace,
                 'resourcehandles', handle_meta['name'],
                 { 'spec': { 'resources': resources_update } }
             )
+            resource_cache.put('resourcehandles', handle)
     except IndexError:
         pass
     except KeyError:
@@ -992,16 +1422,18 @@ def manage_handle_pending_delete(handle, logger):
         delete_resource_claim(resource_claim['namespace'], resource_claim['name'], logger)
 
     try:
-        ko.custom_objects_api.patch_namespaced_custom_object(
+        handle = ko.custom_objects_api.patch_namespaced_custom_object(
             ko.operator_domain, ko.version, ko.operator_namespace,
             'resourcehandles', handle['metadata']['name'],
             { 'metadata': { 'finalizers': None } }
         )
+        resource_cache.put('resourcehandles', handle)
     except kubernetes.client.rest.ApiException as e:
         if e.status != 404:
             raise
 
-def manage_pool(pool, logger):
+@time_async(operation_duration.labels(operation='manage_pool'))
+async def manage_pool_async(pool, logger):
     pool_meta = pool['metadata']
     pool_namespace = pool_meta['namespace']
     pool_name = pool_meta['name']
@@ -1016,39 +1448,74 @@ def manage_pool(pool, logger):
         return
 
     if not pool['metadata'].get('finalizers', None):
-        add_finalizer_to_pool(pool, logger)
+        await run_in_executor(add_finalizer_to_pool, pool, logger)
         return
 
-    with pool_management_lock:
-        unbound_handle_count = len(get_unbound_handles_for_pool(pool_name, logger))
-        handle_deficit = pool['spec'].get('minAvailable', 0) - unbound_handle_count
-        if handle_deficit <= 0:
-            return
-        for i in range(handle_deficit):
-            handle = create_handle_for_pool(pool, logger)
-            log_pool_event(
-                pool, logger, 'Created ResourceHandle for ResourcePool',
-                {
-                    'ResourceHandle': {
-                        'name': handle['metadata']['name'],
-                        'uid': handle['metadata']['uid'],
-                    }
-                },
-            )
+    async with manage_pool_locks.lock(pool_name):
+        available = len(get_unbound_handle_candidates(pool_name))
+        in_flight = pool_handles_in_flight.get(pool_name, 0)
+        handle_deficit = pool['spec'].get('minAvailable', 0) - available - in_flight
+        if handle_deficit > 0:
+            in_flight += handle_deficit
+            pool_handles_in_flight[pool_name] = in_flight
+            for i in range(handle_deficit):
+                task = asyncio.ensure_future(manage_pool_create_handle_async(pool, logger))
+                pool_handle_create_tasks.add(task)
+                task.add_done_callback(pool_handle_create_tasks.discard)
+
+    await update_pool_replenishment_status_async(pool_namespace, pool_name, available, in_flight, logger)
+
+def manage_pool_create_handle(pool, logger):
+    """
+    Create ResourceHandle for ResourcePool from pool handle create executor.
+    """
+    pool_name = pool['metadata']['name']
+    try:
+        pool_handle_create_rate_limiter.acquire()
+        handle = create_handle_for_pool(pool, logger)
+        index_unbound_handle(handle)
+        log_pool_event(
+            pool, logger, 'Created ResourceHandle for ResourcePool',
+            {
+                'ResourceHandle': {
+                    'name': handle['metadata']['name'],
+                    'uid': handle['metadata']['uid'],
+                }
+            },
+        )
+    except Exception as e:
+        logger.exception('Failed to create ResourceHandle for ResourcePool %s', pool_name)
 
-def manage_pool_by_ref(ref, logger):
+async def manage_pool_create_handle_async(pool, logger):
+    """
+    Create ResourceHandle for ResourcePool in the pool handle create executor
+    and account for completion of the in flight handle.
+    """
+    pool_name = pool['metadata']['name']
+    pool_namespace = pool['metadata']['namespace']
     try:
-        pool = ko.custom_objects_api.get_namespaced_custom_object(
-            ko.operator_domain, ko.version, ref['namespace'],
-            'resourcepools', ref['name']
+        await asyncio.get_running_loop().run_in_executor(
+            pool_handle_create_executor, manage_pool_create_handle, pool, logger
         )
-    except kubernetes.client.rest.ApiException as e:
-        if e.status == 404:
-            logger.warning('Unable to find ResourcePool %s in %s', ref['name'], ref['namespace'])
-            return
-        else:
-            raise
-    manage_pool(pool, logger)
+    finally:
+        async with manage_pool_locks.lock(pool_name):
+            in_flight = pool_handles_in_flight[pool_name] - 1
+            if in_flight > 0:
+                pool_handles_in_flight[pool_name] = in_flight
+            else:
+                del pool_handles_in_flight[pool_name]
+            available = len(get_unbound_handle_candidates(pool_name))
+
+    # Report when all creations complete, pool status update then rechecks deficit
+    if in_flight == 0:
+        await update_pool_replenishment_status_async(pool_namespace, pool_name, available, in_flight, logger)
+
+async def manage_pool_by_ref(ref, logger):
+    pool = await get_cached_resource_async('resourcepools', ref['namespace'], ref['name'])
+    if not pool:
+        logger.warning('Unable to find ResourcePool %s in %s', ref['name'], ref['namespace'])
+        return
+    await manage_pool_async(pool, logger)
 
 def manage_pool_deleted(pool, logger):
     pool_meta = pool['metadata']
@@ -1059,39 +1526,68 @@ def manage_pool_pending_delete(pool, logger):
     pool_meta = pool['metadata']
     pool_name = pool_meta['name']
     delete_unbound_handles_for_pool(pool, logger)
-    handle = ko.custom_objects_api.patch_namespaced_custom_object(
+    pool = ko.custom_objects_api.patch_namespaced_custom_object(
         ko.operator_domain, ko.version, ko.operator_namespace, 'resourcepools', pool_name,
         { 'metadata': { 'finalizers': None } }
     )
+    resource_cache.put('resourcepools', pool)
 
+@operation_duration.labels(operation='match_handle_to_claim').time()
 def match_handle_to_claim(claim, logger):
     """
-    List unbound ResourceHandles and attempt to match one to ResourceClaim
+    Search unbound ResourceHandles index and attempt to match one to ResourceClaim
 
     The claim may specify a specific resource pool in an annotation to restrict
-    the search to a specific pool.
+    the search to a specific pool. The returned handle is a copy from the index,
+    the bind is committed with the handle resourceVersion so that the API remains
+    the authority for whether the handle is still available.
     """
     claim_meta = claim['metadata']
     claim_spec = claim['spec']
     claim_status = claim['status']
     annotations = claim_meta.get('annotations', {})
     pool_name = annotations.get(ko.operator_domain + '/resource-pool-name', None)
-    if pool_name:
-        label_selector = '!{0}/resource-claim-name,{0}/resource-pool-name={1}'.format(
-            ko.operator_domain, pool_name
-        )
-    else:
-        label_selector = '!{0}/resource-claim-name'.format(ko.operator_domain)
+    provider_names = tuple(
+        status_resource['provider']['name'] for status_resource in claim_status['resources']
+    )
+    fingerprints = tuple(
+        ResourceProvider.find_provider_by_name(provider_name).template_fingerprint(
+            claim_resource.get('template', {})
+        ) for provider_name, claim_resource in zip(provider_names, claim_spec['resources'])
+    )
 
-    best_match = None
-    best_match_diff_count = None
-    best_match_creation_timestamp = None
-    for handle in ko.custom_objects_api.list_namespaced_custom_object(
-        ko.operator_domain, ko.version, ko.operator_namespace, 'resourcehandles',
-        label_selector=label_selector
-    ).get('items', []):
+    # Handles with matching template fingerprints differ from the claim only in
+    # matchIgnore values so the best of these is found first. If it has no
+    # differences then only older handles can be preferred and the full search
+    # skips template checks for all others.
+    best = match_handle_to_claim_from_candidates(
+        claim, get_unbound_handle_candidates(pool_name, provider_names, fingerprints), logger
+    )
+    best_match, best_match_diff_count = match_handle_to_claim_from_candidates(
+        claim, get_unbound_handle_candidates(pool_name, provider_names), logger, best
+    )
+    if best_match:
+        return copy.deepcopy(best_match)
+
+def match_handle_to_claim_from_candidates(claim, handles, logger, best=None):
+    """
+    Return tuple of best matching ResourceHandle for ResourceClaim from
+    candidate handles and its difference count, or of None if there is no
+    match. A best match and difference count from a previous search may be
+    given to be improved upon.
+    """
+    claim_spec = claim['spec']
+    claim_status = claim['status']
+    best_match, best_match_diff_count = best or (None, None)
+    best_match_creation_timestamp = best_match['metadata']['creationTimestamp'] if best_match else None
+    for handle in handles:
         handle_spec = handle['spec']
 
+        # A match without differences can only be improved on by an older handle
+        if best_match_diff_count == 0 \
+        and handle['metadata']['creationTimestamp'] >= best_match_creation_timestamp:
+            continue
+
         # Do not bind to handles that are deleting
         if 'deletionTimestamp' in handle['metadata']:
             continue
@@ -1118,14 +1614,14 @@ def match_handle_to_claim(claim, logger):
                 is_match = False
                 break
             provider = ResourceProvider.find_provider_by_name(provider_name)
-            diff_patch = provider.check_template_match(
+            template_diff_count = provider.check_template_match(
                 handle_resource.get('template', {}),
                 claim_resource.get('template', {}),
                 logger
             )
-            if diff_patch != None:
-                # Match with (possibly empty) difference list
-                diff_count += len(diff_patch)
+            if template_diff_count != None:
+                # Match with (possibly zero) ignored differences
+                diff_count += template_diff_count
             else:
                 is_match = False
                 break
@@ -1147,7 +1643,7 @@ def match_handle_to_claim(claim, logger):
                 best_match_creation_timestamp = handle['metadata']['creationTimestamp']
                 best_match_diff_count = diff_count
 
-    return best_match
+    return best_match, best_match_diff_count
 
 def maximum_lifespan_end_for_handle(handle, claim):
     """
@@ -1170,22 +1666,135 @@ def maximum_lifespan_end_for_handle(handle, claim):
 
     return end, maximum_type
 
-def pause_for_provider_init():
-    if time.time() < start_time + provider_init_delay:
-        time.sleep(time.time() - start_time)
+def patch_claim_resource_state(claim, resource_index, state):
+    """
+    Patch state for ResourceClaim resource with a JSON patch of only the
+    changes. The patch tests the resourceVersion of the current state so that
+    it fails if the state was changed concurrently.
+    """
+    path = '/status/resources/{}/state'.format(resource_index)
+    current_state = claim['status']['resources'][resource_index].get('state')
+    if current_state:
+        patch = gpte.kubeoperative.create_patch(current_state, state)
+        if not patch:
+            return claim
+        patch = [
+            dict(item, path = path + item['path']) for item in patch
+        ]
+        if 'resourceVersion' in current_state['metadata']:
+            patch.insert(0, {
+                'op': 'test',
+                'path': path + '/metadata/resourceVersion',
+                'value': current_state['metadata']['resourceVersion'],
+            })
+    else:
+        patch = [{'op': 'add', 'path': path, 'value': state}]
+
+    claim = ko.custom_objects_api_jsonpatch.patch_namespaced_custom_object_status(
+        ko.operator_domain, ko.version, claim['metadata']['namespace'], 'resourceclaims',
+        claim['metadata']['name'], patch
+    )
+    resource_cache.put('resourceclaims', claim)
+    return claim
+
+
+def reindex_unbound_handles_for_provider(provider_name):
+    """
+    Recalculate template fingerprints for unbound ResourceHandles which use the
+    ResourceProvider after the provider is added or its matchIgnore changes.
+    """
+    with unbound_handle_index_lock:
+        handles = [
+            unbound_handles[handle_name]
+            for provider_names, handle_names in unbound_handles_by_providers.items()
+            if provider_name in provider_names
+            for handle_name in handle_names
+        ]
+    for handle in handles:
+        fingerprints = handle_resource_fingerprints(handle)
+        with unbound_handle_index_lock:
+            # Skip handle replaced or removed from index since listed
+            if unbound_handles.get(handle['metadata']['name']) is handle:
+                _unindex_handle(handle)
+                _index_handle(handle, fingerprints)
+
+def run_in_executor(func, *args):
+    """
+    Run blocking function in a thread of the event loop default executor.
+
+    Functions run this way must not wait on the event loop, as with ako.run,
+    so that executor threads cannot all be held by work which needs them.
+    """
+    return asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+def schedule_handle_lifespan_end(handle):
+    """
+    Schedule management of ResourceHandle when it reaches the end of its lifespan.
+    The lifespan end of a bound ResourceClaim is set on the ResourceHandle.
+    """
+    handle_name = handle['metadata']['name']
+    lifespan_end = handle['spec'].get('lifespan', {}).get('end')
+    if lifespan_end and 'deletionTimestamp' not in handle['metadata']:
+        # Lifespan is checked as having passed the end, so schedule one second after
+        lifespan_end_scheduler.schedule(
+            handle_name,
+            calendar.timegm(TimeStamp(lifespan_end).datetime.utctimetuple()) + 1
+        )
+    else:
+        lifespan_end_scheduler.cancel(handle_name)
 
-def start_resource_watch(resource_definition):
+def start_requester_watches(logger):
+    """
+    Watch namespaces, users, and identities to invalidate requester caches.
+    Watches are cluster wide so only resource metadata is requested and kept.
+    """
+    if not requester_cache_watch:
+        return
+    for name, cache, kwargs in (
+        ('requester:namespaces', namespace_requester_cache, dict(kind='Namespace')),
+        ('requester:users', openshift_user_cache, dict(kind='User', group='user.openshift.io')),
+        ('requester:identities', openshift_identity_cache, dict(kind='Identity', group='user.openshift.io')),
+    ):
+        try:
+            w = ko.create_watcher(name=name, metadata_only=True, **kwargs)
+        except Exception as e:
+            logger.warning('Unable to watch %s for cache invalidation: %s', kwargs['kind'], e)
+            continue
+        w.handler = requester_watch_handler(cache)
+        w.start()
+
+def requester_watch_handler(cache):
+    # Invalidation is cheap so the handler runs on the watch loop rather than
+    # in the watch handler thread pool
+    async def handler(event, logger):
+        # Invalidate on ADDED as well so that a cached negative lookup does
+        # not outlive creation of the resource
+        if event['type'] in ('ADDED', 'DELETED', 'MODIFIED'):
+            cache.invalidate(event['object']['metadata']['name'])
+    return handler
+
+async def start_resource_watch(resource_definition, reference=None):
     api_version = resource_definition['apiVersion']
     metadata = resource_definition['metadata']
     kind = resource_definition['kind']
     namespace = metadata.get('namespace', None)
 
+    if resource_watch_cluster_scoped:
+        # Watch all namespaces for resources labeled as managed by this operator
+        label_selector = '{}={}'.format(resource_handle_namespace_label, ko.operator_namespace)
+        namespace = None
+    else:
+        label_selector = None
+
     if namespace:
         watcher_name = '{}:{}:{}'.format(api_version, kind, namespace)
     else:
         watcher_name = '{}:{}'.format(api_version, kind)
 
-    if watcher_name in ko.watchers:
+    if reference:
+        if ko.add_watcher_reference(watcher_name, reference):
+            return
+    elif watcher_name in ko.watchers:
         return
 
     if '/' in api_version:
@@ -1193,15 +1802,120 @@ def start_resource_watch(resource_definition):
     else:
         group, version = None, api_version
 
-    w = ko.create_watcher(
+    # Resolve plural before taking the watchers lock as it may require discovery
+    ko.ensure_watcher(
         name=watcher_name,
+        handler=watch_resource_event,
+        reference=reference,
         kind=kind,
         group=group,
+        label_selector=label_selector,
         namespace=namespace,
+        plural=await ako.kind_to_plural(group, version, kind),
         version=version
     )
-    w.handler = watch_resource_event
-    w.start()
+
+def unindex_handle(handle_name, resource_version=None):
+    """
+    Remove ResourceHandle from the unbound handle index. If resource_version
+    is given then earlier versions of the handle are not indexed again,
+    otherwise the handle is forgotten as deleted.
+    """
+    with unbound_handle_index_lock:
+        if resource_version:
+            unbound_handle_versions[handle_name] = resource_version
+        else:
+            unbound_handle_versions.pop(handle_name, None)
+        handle = unbound_handles.get(handle_name)
+        if handle:
+            _unindex_handle(handle)
+
+def _unindex_handle(handle):
+    """
+    Remove ResourceHandle from index, must be called with unbound_handle_index_lock held.
+    """
+    handle_meta = handle['metadata']
+    handle_name = handle_meta['name']
+    pool_name = (handle_meta.get('labels') or {}).get(ko.operator_domain + '/resource-pool-name')
+    provider_names = tuple(
+        resource['provider']['name'] for resource in handle['spec'].get('resources', [])
+    )
+    del unbound_handles[handle_name]
+    if pool_name:
+        pool_handle_names = unbound_handles_by_pool.get(pool_name)
+        if pool_handle_names is not None:
+            pool_handle_names.discard(handle_name)
+            if not pool_handle_names:
+                del unbound_handles_by_pool[pool_name]
+    provider_handle_names = unbound_handles_by_providers.get(provider_names)
+    if provider_handle_names is not None:
+        provider_handle_names.discard(handle_name)
+        if not provider_handle_names:
+            del unbound_handles_by_providers[provider_names]
+    fingerprints = unbound_handle_fingerprints.pop(handle_name, None)
+    if fingerprints:
+        fingerprint_handle_names = unbound_handles_by_fingerprints.get(fingerprints)
+        if fingerprint_handle_names is not None:
+            fingerprint_handle_names.discard(handle_name)
+            if not fingerprint_handle_names:
+                del unbound_handles_by_fingerprints[fingerprints]
+
+def update_claim_resource_state(claim_namespace, claim_name, resource_index, update_state, logger, attempts=3):
+    """
+    Set ResourceClaim resource state to the value returned by
+    update_state(claim, state), where None means no change is needed. Retry
+    with the latest ResourceClaim if the cached claim has no state for the
+    resource or the state was changed concurrently.
+    """
+    for attempt in range(attempts):
+        claim = resource_cache.get('resourceclaims', claim_namespace, claim_name) if attempt == 0 else None
+        cached = claim is not None
+        try:
+            if not cached:
+                claim = ko.custom_objects_api.get_namespaced_custom_object(
+                    ko.operator_domain, ko.version, claim_namespace, 'resourceclaims', claim_name
+                )
+                resource_cache.put('resourceclaims', claim)
+            state = claim['status']['resources'][resource_index].get('state', None)
+            new_state = update_state(claim, state)
+            if new_state:
+                patch_claim_resource_state(claim, resource_index, new_state)
+            return
+        except (IndexError, KeyError):
+            if cached:
+                # Cached ResourceClaim may predate its status, retry with latest
+                continue
+            return
+        except kubernetes.client.rest.ApiException as e:
+            if e.status == 404:
+                logger.info('ResourceClaim %s in %s not found', claim_name, claim_namespace)
+                return
+            # Failed JSON patch test is reported as 422
+            if e.status in (409, 422) and attempt + 1 < attempts:
+                logger.info(
+                    'ResourceClaim %s in %s resource %s state changed, retrying',
+                    claim_name, claim_namespace, resource_index
+                )
+                continue
+            raise
+
+async def update_pool_replenishment_status_async(pool_namespace, pool_name, available, in_flight, logger):
+    replenishment = {
+        'available': available,
+        'inFlight': in_flight,
+    }
+    pool = await get_cached_resource_async('resourcepools', pool_namespace, pool_name)
+    if not pool or pool.get('status', {}).get('replenishment') == replenishment:
+        return
+    try:
+        pool = await ako.patch_namespaced_custom_object_status(
+            ko.operator_domain, ko.version, pool_namespace, 'resourcepools', pool_name,
+            { 'status': { 'replenishment': replenishment } }
+        )
+        resource_cache.put('resourcepools', pool)
+    except kubernetes.client.rest.ApiException as e:
+        if e.status != 404:
+            raise
 
 def validate_claim(claim, logger):
     """
@@ -1234,6 +1948,9 @@ def validate_claim(claim, logger):
             return False
     return True
 
+async def wait_for_providers_loaded():
+    await providers_loaded.wait()
+
 def watch_resource_event(event, logger):
     event_type = event['type']
     if event_type in ['ADDED', 'DELETED', 'MODIFIED']:
@@ -1259,15 +1976,16 @@ def watch_resource_event(event, logger):
             manage_handle_lost_resource(handle_name, resource, resource_index)
 
         if claim_name and claim_namespace:
-            if event_type == 'DELETED':
-                manage_claim_resource_delete(claim_namespace, claim_name, resource, resource_index, logger)
-            else:
-                manage_claim_resource_update(claim_namespace, claim_name, resource, resource_index, logger)
+            claim_resource_status_queue.put(
+                (claim_namespace, claim_name, resource_index),
+                (event_type, resource, logger)
+            )
     else:
         logger.warning(event)
 
 class ResourceProvider(object):
 
+    match_index = MatchIndex()
     providers = {}
     resource_watchers = {}
 
@@ -1281,8 +1999,9 @@ class ResourceProvider(object):
     @staticmethod
     def find_provider_by_template_match(template):
         provider_matches = []
-        for provider in ResourceProvider.providers.values():
-            if provider.is_match_for_template(template):
+        for provider_name in ResourceProvider.match_index.candidates(template):
+            provider = ResourceProvider.providers.get(provider_name)
+            if provider and provider.is_match_for_template(template):
                 provider_matches.append(provider)
         if len(provider_matches) == 0:
             raise kopf.TemporaryError(f"Unable to match template to ResourceProvider", delay=30)
@@ -1294,17 +2013,54 @@ class ResourceProvider(object):
     @staticmethod
     def manage_provider(provider):
         provider = ResourceProvider(provider)
+        current_provider = ResourceProvider.providers.get(provider.name)
         ResourceProvider.providers[provider.name] = provider
+        if provider.match:
+            ResourceProvider.match_index.put(provider.name, provider.match)
+        else:
+            ResourceProvider.match_index.remove(provider.name)
+        if not current_provider \
+        or current_provider.match_ignore != provider.match_ignore:
+            reindex_unbound_handles_for_provider(provider.name)
 
     @staticmethod
     def manage_provider_deleted(provider_name):
         if provider_name in ResourceProvider.providers:
             del ResourceProvider.providers[provider_name]
+        ResourceProvider.match_index.remove(provider_name)
 
     def __init__(self, provider):
         self.metadata = provider['metadata']
         self.spec = provider['spec']
+        self.match_ignore_regexes = [ re.compile(pattern + '$') for pattern in self.match_ignore ]
         self.__init_resource_validator()
+        self.__init_render_plans()
+
+    def __init_render_plans(self):
+        """
+        Precompute claim template defaults, update filters, and plans for
+        template processing so that each render only processes template strings.
+        """
+        defaults = copy.deepcopy(self.spec.get('default', {}))
+        open_api_v3_schema = self.spec.get('validation', {}).get('openAPIV3Schema', None)
+        if open_api_v3_schema:
+            schema_defaults = defaults_from_schema(open_api_v3_schema)
+            if schema_defaults:
+                dict_merge(defaults, schema_defaults)
+        self.claim_template_defaults = defaults
+
+        if self.template_enable:
+            self.claim_template_defaults_plan = TemplatePlan(defaults, self.template_style)
+            self.override_plan = TemplatePlan(self.override, self.template_style)
+        else:
+            self.claim_template_defaults_plan = None
+            self.override_plan = None
+
+        self.update_filters = gpte.kubeoperative.UpdateFilters(
+            self.spec.get('updateFilters', []) + [{
+                'pathMatch': '/metadata/annotations/' + re.escape(ko.operator_domain) + '~1resource-.*'
+            }]
+        )
 
     def __init_resource_validator(self):
         open_api_v3_schema = self.spec.get('validation', {}).get('openAPIV3Schema', None)
@@ -1374,22 +2130,31 @@ class ResourceProvider(object):
     def check_template_match(self, handle_resource, claim_resource, logger):
         """
         Check if a resource in a handle matches a resource in a claim
+
+        Return the count of differences in paths ignored by matchIgnore or None
+        if the resources do not match.
         """
-        patch = [
-            item for item in gpte.kubeoperative.jsonpatch_from_diff(
-                handle_resource, claim_resource
-            ) if item['op'] in ['add', 'replace']
-        ]
-        # Return false if any item from the patch is not ignored
-        ignore_re_list = [ re.compile(pattern + '$') for pattern in self.match_ignore ]
-        for item in patch:
-            ignored = False
-            for ignore_re in ignore_re_list:
-                if ignore_re.match(item['path']):
-                    ignored = True
-            if not ignored:
-                return None
-        return patch
+        return gpte.kubeoperative.jsonpatch_diff_count(
+            handle_resource, claim_resource,
+            ops = ('add', 'replace'),
+            path_predicate = self.is_match_ignored_path,
+        )
+
+    def is_match_ignored_path(self, path):
+        """
+        Check if JSON pointer path is ignored for template matching.
+        """
+        for ignore_re in self.match_ignore_regexes:
+            if ignore_re.match(path):
+                return True
+        return False
+
+    def template_fingerprint(self, template):
+        """
+        Return fingerprint for resource template which ignores values in
+        paths matched by matchIgnore.
+        """
+        return template_fingerprint(template, self.match_ignore_regexes)
 
     def is_match_for_template(self, template):
         """
@@ -1398,37 +2163,28 @@ class ResourceProvider(object):
         """
         if not self.match:
             return False
-        cmp_template = copy.deepcopy(template)
-        dict_merge(cmp_template, self.match)
-        return template == cmp_template
+        return template == dict_merged(template, self.match)
 
     def resource_claim_template_defaults(self, resource_claim, resource_index):
-        defaults = self.spec.get('default', {})
-        open_api_v3_schema = self.spec.get('validation', {}).get('openAPIV3Schema', None)
-
-        if open_api_v3_schema:
-            schema_defaults = defaults_from_schema(open_api_v3_schema)
-            if schema_defaults:
-                dict_merge(defaults, schema_defaults)
-
+        defaults = self.claim_template_defaults
         if not defaults:
             return
-        elif self.template_enable:
-            return recursive_process_template_strings(
-                defaults, self.template_style,
-                {
-                    'resource_claim': resource_claim,
-                    'resource_index': resource_index,
-                    'resource_name': resource_claim['spec']['resources'][resource_index].get('name'),
-                    'resource_provider': self,
-                }
-            )
+        elif self.claim_template_defaults_plan:
+            with template_render_duration.time():
+                return self.claim_template_defaults_plan.process(
+                    {
+                        'resource_claim': resource_claim,
+                        'resource_index': resource_index,
+                        'resource_name': resource_claim['spec']['resources'][resource_index].get('name'),
+                        'resource_provider': self,
+                    }
+                )
         else:
             return defaults
 
-    def resource_definition_from_template(self, handle, claim, resource_index, logger):
+    async def resource_definition_from_template(self, handle, claim, resource_index, logger):
         if claim:
-            requester_identity, requester_user = get_requester_from_namespace(
+            requester_identity, requester_user = await get_requester_from_namespace_async(
                 claim['metadata']['namespace']
             )
         else:
@@ -1446,13 +2202,13 @@ class ResourceProvider(object):
         handle_resource = handle['spec']['resources'][resource_index]
         resource_reference = handle_resource.get('reference', {})
         resource_template = handle_resource.get('template', {})
-        resource = copy.deepcopy(resource_template)
+        # The resource definition shares unmodified values with the handle
+        # template and provider override, only merged paths and the metadata
+        # which is set below are copied.
         if 'override' in self.spec:
-            if self.template_enable:
-                dict_merge(
-                    resource,
-                    recursive_process_template_strings(
-                        self.override, self.template_style,
+            if self.override_plan:
+                with template_render_duration.time():
+                    override = self.override_plan.process(
                         {
                             "guid": guid,
                             "requester_identity": requester_identity,
@@ -1465,13 +2221,14 @@ class ResourceProvider(object):
                             "resource_reference": resource_reference,
                             "resource_template": resource_template,
                         },
-                    ),
-                )
+                    )
+                resource = dict_merged(resource_template, override)
             else:
-                dict_merge(resource, self.override)
+                resource = dict_merged(resource_template, self.override)
+        else:
+            resource = dict(resource_template)
 
-        if 'metadata' not in resource:
-            resource['metadata'] = {}
+        resource['metadata'] = dict(resource.get('metadata', {}))
         if 'name' not in resource['metadata']:
             # If name prefix was not given then use prefix "guidN-" with resource index to
             # prevent name conflicts. If the resource template does specify a name prefix
@@ -1480,8 +2237,8 @@ class ResourceProvider(object):
                 resource['metadata']['generateName'] = 'guid{}-'.format(resource_index)
             resource['metadata']['name'] = \
                 resource['metadata']['generateName'] + guid
-        if 'annotations' not in resource['metadata']:
-            resource['metadata']['annotations'] = {}
+        resource['metadata']['annotations'] = dict(resource['metadata'].get('annotations', {}))
+        resource['metadata']['labels'] = dict(resource['metadata'].get('labels', {}))
         if 'apiVersion' not in resource:
             raise kopf.PermanentError(f"Template processing for ResourceProvider {self.name} produced definition without an apiVersion!")
         if 'kind' not in resource:
@@ -1497,6 +2254,8 @@ class ResourceProvider(object):
             if resource['kind'] != resource_reference['kind']:
                 raise kopf.PermanentError(f"Unable to change kind for resource!")
 
+        if resource_watch_cluster_scoped:
+            resource['metadata']['labels'][resource_handle_namespace_label] = handle['metadata']['namespace']
         resource['metadata']['annotations'].update({
             ko.operator_domain + '/resource-provider-name': self.name,
             ko.operator_domain + '/resource-provider-namespace': self.namespace,
@@ -1527,7 +2286,7 @@ class ResourceProvider(object):
             })
         return resource
 
-    def update_resource(self, handle, resource, resource_definition, logger):
+    async def update_resource(self, handle, resource, resource_definition, logger):
         handle_uid = handle['metadata']['uid']
         handle_version = handle['metadata']['resourceVersion']
 
@@ -1539,14 +2298,32 @@ class ResourceProvider(object):
         if 'namespace' in resource['metadata']:
             resource_ref['namespace'] = resource['metadata']['namespace']
 
-        update_filters = self.spec.get('updateFilters', []) + [{
-            'pathMatch': '/metadata/annotations/' + re.escape(ko.operator_domain) + '~1resource-.*'
-        }]
-        patched_resource, changed = ko.patch_resource(
-            resource=resource,
-            patch=resource_definition,
-            update_filters=update_filters
-        )
+        patch = gpte.kubeoperative.create_patch(resource, resource_definition, self.update_filters)
+
+        # The handle namespace label selects resources for cluster scoped
+        # watches so it is set regardless of update filters, without adding
+        # any other labels from the resource definition.
+        if resource_watch_cluster_scoped:
+            labels = resource['metadata'].get('labels')
+            label_value = handle['metadata']['namespace']
+            if not labels:
+                label_op = {
+                    'op': 'add',
+                    'path': '/metadata/labels',
+                    'value': { resource_handle_namespace_label: label_value },
+                }
+            elif labels.get(resource_handle_namespace_label) != label_value:
+                label_op = {
+                    'op': 'add',
+                    'path': '/metadata/labels/' + resource_handle_namespace_label.replace('~', '~0').replace('/', '~1'),
+                    'value': label_value,
+                }
+            else:
+                label_op = None
+            if label_op and not any(item['path'] == label_op['path'] for item in patch):
+                patch.append(label_op)
+
+        patched_resource, changed = await ako.patch_resource(resource=resource, patch=patch)
         if changed:
             log_handle_event(handle, logger, 'Updated resource', {'Resource': resource_ref})
         else:
@@ -1586,8 +2363,8 @@ def resource_provider_event(event, logger, **_):
     else:
         logger.warning('Unhandled ResourceProvider event %s', event)
 
-def handle_resource_claim_event(annotations, labels, meta, name, namespace, spec, status, uid, logger, **_):
-    manage_claim({
+async def handle_resource_claim_event(annotations, labels, meta, name, namespace, spec, status, uid, logger, **_):
+    await manage_claim_async({
         "apiVersion": f"{ko.operator_domain}/{ko.version}",
         "kind": "ResourceClaim",
         "metadata": {
@@ -1604,78 +2381,128 @@ def handle_resource_claim_event(annotations, labels, meta, name, namespace, spec
     }, logger)
 
 @kopf.on.create(ko.operator_domain, ko.version, 'resourceclaims')
-def resource_claim_create(**kwargs):
-    pause_for_provider_init()
-    handle_resource_claim_event(**kwargs)
+async def resource_claim_create(**kwargs):
+    await wait_for_providers_loaded()
+    await handle_resource_claim_event(**kwargs)
 
 @kopf.on.resume(ko.operator_domain, ko.version, 'resourceclaims')
-def resource_claim_resume(**kwargs):
-    pause_for_provider_init()
-    handle_resource_claim_event(**kwargs)
+async def resource_claim_resume(**kwargs):
+    await wait_for_providers_loaded()
+    await handle_resource_claim_event(**kwargs)
 
 @kopf.on.update(ko.operator_domain, ko.version, 'resourceclaims')
-def resource_claim_update(**kwargs):
-    pause_for_provider_init()
-    handle_resource_claim_event(**kwargs)
+async def resource_claim_update(**kwargs):
+    await wait_for_providers_loaded()
+    await handle_resource_claim_event(**kwargs)
 
 @kopf.on.event(ko.operator_domain, ko.version, 'resourceclaims')
-def resource_claim_event(event, logger, **_):
-    pause_for_provider_init()
+async def resource_claim_event(event, logger, **_):
+    await wait_for_providers_loaded()
     claim = event.get('object')
     if event['type'] == 'DELETED':
-        manage_claim_deleted(claim, logger)
+        resource_cache.remove(
+            'resourceclaims', claim['metadata']['namespace'], claim['metadata']['name'],
+            claim['metadata'].get('resourceVersion')
+        )
+        await run_in_executor(manage_claim_deleted, claim, logger)
+    else:
+        resource_cache.put('resourceclaims', claim)
 
 @kopf.on.event(ko.operator_domain, ko.version, 'resourcehandles')
-def resource_handle_event(event, logger, **_):
-    pause_for_provider_init()
+async def resource_handle_event(event, logger, **_):
+    await wait_for_providers_loaded()
     handle = event['object']
     if event['type'] == 'DELETED':
-        manage_handle_deleted(handle, logger)
+        resource_cache.remove(
+            'resourcehandles', handle['metadata']['namespace'], handle['metadata']['name'],
+            handle['metadata'].get('resourceVersion')
+        )
+        unindex_handle(handle['metadata']['name'])
+        lifespan_end_scheduler.cancel(handle['metadata']['name'])
+        await manage_handle_deleted(handle, logger)
     elif event['type'] in ['ADDED', 'MODIFIED', None]:
-        manage_handle(handle, logger)
+        resource_cache.put('resourcehandles', handle)
+        index_unbound_handle(handle)
+        schedule_handle_lifespan_end(handle)
+        await manage_handle_async(handle, logger)
     else:
         logger.warning('Unhandled ResourceHandle event %s', event)
 
 @kopf.on.event(ko.operator_domain, ko.version, 'resourcepools')
-def resource_pool_event(event, logger, **_):
-    pause_for_provider_init()
+async def resource_pool_event(event, logger, **_):
+    await wait_for_providers_loaded()
     if event['type'] == 'DELETED':
         pool = event['object']
+        resource_cache.remove(
+            'resourcepools', pool['metadata']['namespace'], pool['metadata']['name'],
+            pool['metadata'].get('resourceVersion')
+        )
         manage_pool_deleted(pool, logger)
     elif event['type'] in ['ADDED', 'MODIFIED', None]:
         pool = event['object']
+        resource_cache.put('resourcepools', pool)
         if 'deletionTimestamp' in pool['metadata']:
-            manage_pool_pending_delete(pool, logger)
+            await run_in_executor(manage_pool_pending_delete, pool, logger)
         else:
-            manage_pool(pool, logger)
+            await manage_pool_async(pool, logger)
     else:
         logger.warning('Unhandled ResourcePool event %s', event)
 
 def manage_handles(logger):
+    """
+    Periodic pass to manage all ResourceHandles using a pool of worker threads.
+    Per-handle locks in manage_handle prevent concurrent management of the same
+    handle by the workers and event handlers.
+    """
     _continue = None
+    handle_count = 0
+    start = time.monotonic()
+
+    # Limit queued handles so that pages are only listed as workers are available
+    queue_semaphore = threading.BoundedSemaphore(manage_handles_workers * 2)
+
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers = manage_handles_workers,
+        thread_name_prefix = 'manage_handles',
+    ) as executor:
+        while True:
+            kwargs = { "limit": manage_handles_page_size }
+            if _continue:
+                kwargs['_continue'] = _continue
+
+            resp = ko.custom_objects_api.list_namespaced_custom_object(
+                ko.operator_domain, ko.version, ko.operator_namespace, 'resourcehandles',
+                **kwargs
+            )
+            for handle in resp.get('items', []):
+                queue_semaphore.acquire()
+                future = executor.submit(manage_handles_item, handle)
+                future.add_done_callback(lambda _: queue_semaphore.release())
+                handle_count += 1
+
+            _continue = resp['metadata'].get('continue')
+            if not _continue:
+                break
 
-    while True:
-        kwargs = { "limit": 20 }
-        if _continue:
-            kwargs['_continue'] = _continue
-
-        resp = ko.custom_objects_api.list_namespaced_custom_object(
-            ko.operator_domain, ko.version, ko.operator_namespace, 'resourcehandles',
-            **kwargs
+    duration = time.monotonic() - start
+    manage_handles_pass_duration.set(duration)
+    if duration > manage_handles_interval:
+        logger.warning(
+            'Managed %d ResourceHandles in %.1f seconds, longer than interval %d seconds',
+            handle_count, duration, manage_handles_interval
         )
-        for handle in resp.get('items', []):
-            object_logger = kopf.LocalObjectLogger(
-                body = handle,
-                settings = kopf.OperatorSettings(),
-            )
-            try:
-                manage_handle(handle, object_logger)
-            except Exception as e:
-                object_logger.exception("Error managing handle")
+    else:
+        logger.info('Managed %d ResourceHandles in %.1f seconds', handle_count, duration)
 
-        _continue = resp['metadata'].get('continue')
-        if not _continue:
-            break
+def manage_handles_item(handle):
+    object_logger = kopf.LocalObjectLogger(
+        body = handle,
+        settings = kopf.OperatorSettings(),
+    )
+    try:
+        manage_handle(handle, object_logger)
+    except Exception as e:
+        object_logger.exception("Error managing handle")
 
 def manage_handles_loop():
     logger = logging.getLogger('resourcehandles')
@@ -1687,10 +2514,22 @@ def manage_handles_loop():
             logger.exception("Error in resourcehandles")
 
 @kopf.on.startup()
-def on_startup(logger, **kwargs):
+async def on_startup(logger, **kwargs):
     """Main function."""
+    prometheus_client.start_http_server(metrics_port)
+    await run_in_executor(load_resource_providers, logger)
+    providers_loaded.set()
+    await run_in_executor(load_unbound_handle_index, logger)
+    await run_in_executor(start_requester_watches, logger)
+    lifespan_end_scheduler.start()
+    claim_resource_status_queue.start()
     threading.Thread(
         name = 'manage_handles',
         daemon = True,
         target = manage_handles_loop,
     ).start()
+
+@kopf.on.cleanup()
+async def on_cleanup(logger, **kwargs):
+    await run_in_executor(ko.watch_multiplexer.shutdown)
+    await ako.close()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+"""
+Microbenchmark for building a resource definition from a handle template and
+provider override, comparing deepcopy with dict_merge against the
+copy-on-write dict_merged as used in ResourceProvider.
+
+Run from the test directory: python benchmark-dict_merge.py
+"""
+
+import copy
+import sys
+import timeit
+sys.path.append('../operator')
+
+from gpte.util import dict_merge, dict_merged
+
+template = {
+    'apiVersion': 'anarchy.gpte.redhat.com/v1',
+    'kind': 'AnarchySubject',
+    'metadata': {
+        'annotations': {'poolboy.gpte.redhat.com/resource-pool-name': 'test'},
+        'generateName': 'test-',
+        'namespace': 'anarchy',
+    },
+    'spec': {
+        'governor': 'test',
+        'vars': {
+            'job_vars': {
+                'guid': 'abcde',
+                'list': [{'name': 'item-{}'.format(i), 'value': i} for i in range(50)],
+                'nested': {
+                    'key-{}'.format(i): {'a': i, 'b': [i] * 5} for i in range(20)
+                },
+            },
+        },
+    },
+}
+
+override = {
+    'metadata': {'namespace': 'anarchy-operator'},
+    'spec': {'vars': {'desired_state': 'started', 'job_vars': {'guid': 'fghij'}}},
+}
+
+def deepcopy_merge():
+    resource = copy.deepcopy(template)
+    dict_merge(resource, override)
+    return resource
+
+def copy_on_write_merge():
+    return dict_merged(template, override)
+
+def main():
+    assert deepcopy_merge() == copy_on_write_merge()
+    number = 5000
+    for impl in (deepcopy_merge, copy_on_write_merge):
+        seconds = timeit.timeit(impl, number=number)
+        print('{:<20} {:8.2f} us/merge'.format(impl.__name__, seconds / number * 1e6))
+
+if __name__ == '__main__':
+    main()
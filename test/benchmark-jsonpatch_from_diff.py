@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+"""
+Microbenchmark for jsonpatch_from_diff, compared with the previous recursive
+generator implementation, which is also used to check that both produce the
+same patches for randomly generated resources.
+
+Run from the test directory: python benchmark-jsonpatch_from_diff.py
+"""
+
+import copy
+import random
+import sys
+import timeit
+sys.path.append('../operator')
+
+from gpte.kubeoperative import jsonpatch_from_diff
+
+def _recursive_jsonpatch_path(*path):
+    return '/' + '/'.join([
+        p.replace('~', '~0').replace('/', '~1') for p in path
+    ])
+
+def _recursive_jsonpatch_from_diff(a, b, path):
+    if isinstance(a, dict) and isinstance(b, dict):
+        for k, v in a.items():
+            if k in b:
+                yield from _recursive_jsonpatch_from_diff(v, b[k], path + [k])
+            else:
+                yield dict(op='remove', path=_recursive_jsonpatch_path(*path, k))
+        for k, v in b.items():
+            if k not in a:
+                yield dict(op='add', path=_recursive_jsonpatch_path(*path, k), value=v)
+    elif isinstance(a, list) and isinstance(b, list):
+        for i in range(min(len(a), len(b))):
+            yield from _recursive_jsonpatch_from_diff(a[i], b[i], path + [str(i)])
+        for i in range(len(a) - 1, len(b) -1, -1):
+            yield dict(op='remove', path=_recursive_jsonpatch_path(*path, str(i)))
+        for i in range(len(a), len(b)):
+            yield dict(op='add', path=_recursive_jsonpatch_path(*path, str(i)), value=b[i])
+    elif a != b:
+        yield dict(op='replace', path=_recursive_jsonpatch_path(*path), value=b)
+
+def recursive_jsonpatch_from_diff(a, b):
+    return list(_recursive_jsonpatch_from_diff(a, b, []))
+
+def random_value(rng, depth):
+    r = rng.random()
+    if depth > 0 and r < 0.3:
+        return {
+            rng.choice(['a', 'b', 'c/d', 'e~f', 'g', 'h']): random_value(rng, depth - 1)
+            for i in range(rng.randint(0, 5))
+        }
+    elif depth > 0 and r < 0.45:
+        return [random_value(rng, depth - 1) for i in range(rng.randint(0, 4))]
+    else:
+        return rng.choice([None, True, 0, 1, 'x', 'y'])
+
+def mutate(rng, value):
+    if isinstance(value, dict):
+        value = dict(value)
+        for k in list(value):
+            r = rng.random()
+            if r < 0.1:
+                del value[k]
+            elif r < 0.3:
+                value[k] = mutate(rng, value[k])
+        if rng.random() < 0.1:
+            value['new'] = random_value(rng, 2)
+    elif isinstance(value, list):
+        value = [mutate(rng, v) if rng.random() < 0.3 else v for v in value]
+        if value and rng.random() < 0.1:
+            value.pop()
+        if rng.random() < 0.1:
+            value.append(random_value(rng, 2))
+    elif rng.random() < 0.5:
+        value = random_value(rng, 2)
+    return value
+
+def resource(i):
+    return {
+        'apiVersion': 'anarchy.gpte.redhat.com/v1',
+        'kind': 'AnarchySubject',
+        'metadata': {
+            'annotations': {
+                'poolboy.gpte.redhat.com/resource-handle-name': 'guid-{:05d}'.format(i),
+                'poolboy.gpte.redhat.com/resource-index': '0',
+            },
+            'labels': {'app': 'test'},
+            'name': 'test-{}'.format(i),
+            'namespace': 'anarchy',
+        },
+        'spec': {
+            'governor': 'test',
+            'vars': {
+                'job_vars': {
+                    'guid': 'guid-{:05d}'.format(i),
+                    'list': [{'name': 'item-{}'.format(j), 'value': j} for j in range(50)],
+                },
+            },
+        },
+    }
+
+def main():
+    rng = random.Random(0)
+    for i in range(2000):
+        a = random_value(rng, 5)
+        b = mutate(rng, a)
+        assert jsonpatch_from_diff(a, b) == recursive_jsonpatch_from_diff(a, b), (a, b)
+
+    a = resource(0)
+    unchanged = copy.deepcopy(a)
+    changed = copy.deepcopy(a)
+    changed['spec']['vars']['job_vars']['list'][25]['value'] = 'changed'
+    changed['metadata']['labels']['new'] = 'label'
+
+    number = 2000
+    for name, b in (('unchanged', unchanged), ('changed', changed)):
+        for impl in (recursive_jsonpatch_from_diff, jsonpatch_from_diff):
+            seconds = timeit.timeit(lambda: impl(a, b), number=number)
+            print('{:<10} {:<32} {:8.2f} us/diff'.format(name, impl.__name__, seconds / number * 1e6))
+
+if __name__ == '__main__':
+    main()
@@ -5,7 +5,7 @@ import unittest
 import sys
 sys.path.append('../operator')
 
-from gpte.kubeoperative import jsonpatch_from_diff
+from gpte.kubeoperative import UpdateFilters, create_patch, jsonpatch_diff_count, jsonpatch_from_diff
 
 class TestJsonPatch(unittest.TestCase):
     def test_00(self):
@@ -138,5 +138,111 @@ class TestJsonPatch(unittest.TestCase):
             {'op': 'add', 'path': '/0/d/3', 'value':4},
         ])
 
+class TestJsonPatchDiffCount(unittest.TestCase):
+    def test_00(self):
+        a = {'a': 1, 'b': [1, 2], 'c': 'x'}
+        b = {'a': 2, 'b': [1], 'd': 'y'}
+        self.assertEqual(jsonpatch_diff_count(a, b), len(jsonpatch_from_diff(a, b)))
+
+    def test_01(self):
+        # op filter excludes removes
+        a = {'a': 1, 'b': [1, 2], 'c': 'x'}
+        b = {'a': 2, 'b': [1], 'd': 'y'}
+        self.assertEqual(jsonpatch_diff_count(a, b, ops=('add', 'replace')), 2)
+
+    def test_02(self):
+        # path predicate rejects difference
+        a = {'spec': {'a': 1, 'b': 2}}
+        b = {'spec': {'a': 2, 'b': 3}}
+        self.assertEqual(jsonpatch_diff_count(a, b, path_predicate=lambda path: path == '/spec/a'), None)
+        self.assertEqual(jsonpatch_diff_count(a, b, path_predicate=lambda path: path.startswith('/spec/')), 2)
+
+    def test_03(self):
+        # stops at first rejected path
+        paths = []
+        def path_predicate(path):
+            paths.append(path)
+            return False
+        a = {'a': 1, 'b': 2, 'c': 3}
+        b = {'a': 2, 'b': 3, 'c': 4}
+        self.assertEqual(jsonpatch_diff_count(a, b, path_predicate=path_predicate), None)
+        self.assertEqual(paths, ['/a'])
+
+    def test_04(self):
+        self.assertEqual(jsonpatch_diff_count({'a': [1]}, {'a': [1]}, path_predicate=lambda path: False), 0)
+
+class TestCreatePatch(unittest.TestCase):
+    update_filters = [
+        { 'pathMatch': '/metadata/.*', 'allowedOps': ['add', 'replace'] },
+        { 'pathMatch': '/spec/(a|b)', 'allowedOps': ['replace'] },
+        { 'pathMatch': '/spec/.*' },
+    ]
+
+    def test_00(self):
+        a = {'metadata': {'name': 'a', 'x': 1}, 'spec': {'a': 1, 'c': 1}}
+        b = {'metadata': {'name': 'b', 'y': 1}, 'spec': {'a': 2, 'b': 2}, 'status': {}}
+        expected = [
+            {'op': 'replace', 'path': '/metadata/name', 'value': 'b'},
+            {'op': 'add', 'path': '/metadata/y', 'value': 1},
+            {'op': 'replace', 'path': '/spec/a', 'value': 2},
+            {'op': 'remove', 'path': '/spec/c'},
+        ]
+        self.assertEqual(create_patch(a, b, self.update_filters), expected)
+        self.assertEqual(create_patch(a, b, UpdateFilters(self.update_filters)), expected)
+
+    def test_01(self):
+        a = {'spec': {'a': 1}}
+        b = {'spec': {'a': 2}, 'status': {}}
+        self.assertEqual(create_patch(a, b), jsonpatch_from_diff(a, b))
+        self.assertEqual(create_patch(a, b, UpdateFilters([])), jsonpatch_from_diff(a, b))
+
+    def test_02(self):
+        # Filters which cannot be combined into a single regular expression
+        update_filters = UpdateFilters([
+            { 'pathMatch': '/(?P<x>a)', 'allowedOps': ['add'] },
+            { 'pathMatch': '/(?P<x>b)' },
+        ])
+        self.assertTrue(update_filters.allows('add', '/a'))
+        self.assertFalse(update_filters.allows('remove', '/a'))
+        self.assertTrue(update_filters.allows('remove', '/b'))
+        self.assertFalse(update_filters.allows('add', '/c'))
+
+    def test_03(self):
+        # Top level alternation must match the full path in both forms
+        for update_filters in (
+            UpdateFilters([{ 'pathMatch': '/a|/b' }]),
+            UpdateFilters([{ 'pathMatch': '/(?P<x>a)|/b' }, { 'pathMatch': '/(?P<x>c)' }]),
+        ):
+            self.assertTrue(update_filters.allows('add', '/a'))
+            self.assertTrue(update_filters.allows('add', '/b'))
+            self.assertFalse(update_filters.allows('add', '/a/x'))
+            self.assertFalse(update_filters.allows('add', '/bx'))
+
+    def test_04(self):
+        # Invalid pattern is skipped without affecting other filters
+        with self.assertLogs('update_filters', level='WARNING'):
+            update_filters = UpdateFilters([
+                { 'pathMatch': '/a(' },
+                { 'pathMatch': '/b', 'allowedOps': ['add'] },
+            ])
+        self.assertTrue(update_filters.allows('add', '/b'))
+        self.assertFalse(update_filters.allows('remove', '/b'))
+        self.assertFalse(update_filters.allows('add', '/a('))
+        with self.assertLogs('update_filters', level='WARNING'):
+            update_filters = UpdateFilters([{ 'pathMatch': '[' }])
+        self.assertFalse(update_filters.allows('add', '/a'))
+
+    def test_05(self):
+        # Leading global inline flags apply to their own pattern only
+        for update_filters in (
+            UpdateFilters([{ 'pathMatch': '(?i)/a|/b' }, { 'pathMatch': '/c' }]),
+            UpdateFilters([{ 'pathMatch': '(?i)(?s)/(?P<x>a)|/b' }, { 'pathMatch': '/(?P<x>c)' }]),
+        ):
+            self.assertTrue(update_filters.allows('add', '/A'))
+            self.assertTrue(update_filters.allows('add', '/B'))
+            self.assertTrue(update_filters.allows('add', '/c'))
+            self.assertFalse(update_filters.allows('add', '/C'))
+            self.assertFalse(update_filters.allows('add', '/Ax'))
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+
+import aiohttp.web
+import asyncio
+import kubernetes
+import threading
+import time
+import unittest
+import sys
+sys.path.append('../operator')
+
+from gpte.kubeoperative import ResourceCache, WatchMultiplexer, api_call_verb_and_resource, is_newer_resource_version
+
+def resource(name, resource_version, **spec):
+    return {
+        'metadata': {'name': name, 'namespace': 'test', 'resourceVersion': resource_version},
+        'spec': spec,
+    }
+
+class TestResourceCache(unittest.TestCase):
+    def test_00(self):
+        cache = ResourceCache()
+        cache.put('tests', resource('a', '2', x=1))
+        cache.put('tests', resource('a', '1', x=2))
+        self.assertEqual(cache.get('tests', 'test', 'a')['spec'], {'x': 1})
+        cache.put('tests', resource('a', '3', x=3))
+        self.assertEqual(cache.get('tests', 'test', 'a')['spec'], {'x': 3})
+        cache.remove('tests', 'test', 'a')
+        self.assertEqual(cache.get('tests', 'test', 'a'), None)
+
+    def test_01(self):
+        # Changes to resources put in or returned from the cache are not cached
+        cache = ResourceCache()
+        a = resource('a', '1', x=1)
+        cache.put('tests', a)
+        a['spec']['x'] = 2
+        self.assertEqual(cache.get('tests', 'test', 'a')['spec'], {'x': 1})
+        cache.get('tests', 'test', 'a')['spec']['x'] = 3
+        self.assertEqual(cache.get('tests', 'test', 'a')['spec'], {'x': 1})
+
+    def test_02(self):
+        cache = ResourceCache(enabled=False)
+        cache.put('tests', resource('a', '1'))
+        self.assertEqual(cache.get('tests', 'test', 'a'), None)
+
+    def test_03(self):
+        # Response read before delete is not cached after the delete event
+        cache = ResourceCache()
+        cache.put('tests', resource('a', '1', x=1))
+        cache.remove('tests', 'test', 'a', '2')
+        cache.put('tests', resource('a', '1', x=1))
+        self.assertEqual(cache.get('tests', 'test', 'a'), None)
+        cache.put('tests', resource('a', '2', x=2))
+        self.assertEqual(cache.get('tests', 'test', 'a'), None)
+        # Recreated resource has a newer resourceVersion
+        cache.put('tests', resource('a', '3', x=3))
+        self.assertEqual(cache.get('tests', 'test', 'a')['spec'], {'x': 3})
+        self.assertEqual(cache.tombstones, {})
+
+    def test_04(self):
+        # Same version is not cached again
+        cache = ResourceCache()
+        cache.put('tests', resource('a', '1', x=1))
+        cache.put('tests', resource('a', '1', x=2))
+        self.assertEqual(cache.get('tests', 'test', 'a')['spec'], {'x': 1})
+
+    def test_05(self):
+        cache = ResourceCache(tombstone_ttl=-1)
+        cache.remove('tests', 'test', 'a', '2')
+        cache.remove('tests', 'test', 'b', '3')
+        self.assertEqual(list(cache.tombstones), [('tests', 'test', 'b')])
+
+class TestApiCallVerbAndResource(unittest.TestCase):
+    def test_00(self):
+        for args, expected in (
+            (('/api/v1/namespaces/{name}', 'GET', {'name': 'test'}, []), ('get', 'namespaces')),
+            (('/api/v1/namespaces/{namespace}/pods', 'GET', {'namespace': 'test'}, []), ('list', 'pods')),
+            (('/api/v1/namespaces/{namespace}/pods', 'GET', {'namespace': 'test'}, [('watch', True)]), ('watch', 'pods')),
+            (('/api/v1/namespaces/{namespace}/pods/{name}', 'DELETE', {'namespace': 'test', 'name': 'a'}, []), ('delete', 'pods')),
+            (('/api/v1/namespaces/{namespace}/pods', 'DELETE', {'namespace': 'test'}, []), ('deletecollection', 'pods')),
+            (('/apis/{group}/{version}/namespaces/{namespace}/{plural}', 'POST', {'plural': 'resourceclaims'}, []), ('create', 'resourceclaims')),
+            (('/apis/{group}/{version}/namespaces/{namespace}/{plural}/{name}/status', 'PATCH', {'plural': 'resourceclaims'}, []), ('patch', 'resourceclaims/status')),
+            (('/apis/{group}/{version}/{plural}/{name}', 'PUT', {'plural': 'users'}, []), ('update', 'users')),
+            (('/apis/poolboy.gpte.redhat.com/v1', 'GET', None, None), ('get', 'discovery')),
+            (('/api/v1', 'GET', None, None), ('get', 'discovery')),
+        ):
+            self.assertEqual(api_call_verb_and_resource(*args), expected, args)
+
+class TestIsNewerResourceVersion(unittest.TestCase):
+    def test_00(self):
+        self.assertTrue(is_newer_resource_version('10', '9'))
+        self.assertFalse(is_newer_resource_version('9', '10'))
+        self.assertFalse(is_newer_resource_version('9', '9'))
+        self.assertTrue(is_newer_resource_version('b', 'a'))
+        self.assertFalse(is_newer_resource_version('a', 'a'))
+
+class FakeOperative(object):
+    def __init__(self, host='http://127.0.0.1'):
+        self.api_configuration = kubernetes.client.Configuration(host=host)
+        self.watchers = {}
+
+class FakeWatcher(object):
+    def __init__(self, name, watch_loop):
+        self.name = name
+        self.watch_loop = watch_loop
+
+class TestWatchMultiplexer(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.runner = None
+
+    def tearDown(self):
+        if self.runner:
+            asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result(5)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(5)
+        self.loop.close()
+
+    def start_server(self, handler):
+        async def start():
+            app = aiohttp.web.Application()
+            app.router.add_get('/{path:.*}', handler)
+            self.runner = aiohttp.web.AppRunner(app)
+            await self.runner.setup()
+            site = aiohttp.web.TCPSite(self.runner, '127.0.0.1', 0)
+            await site.start()
+            return self.runner.addresses[0][1]
+        port = asyncio.run_coroutine_threadsafe(start(), self.loop).result(5)
+        return 'http://127.0.0.1:{}'.format(port)
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time.monotonic() + timeout
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return condition()
+
+    def test_00(self):
+        # Watches run as tasks until stopped, starting a running watch is a no-op
+        multiplexer = WatchMultiplexer(FakeOperative())
+        started = []
+        async def watch_loop():
+            started.append(True)
+            await asyncio.Event().wait()
+        watcher = FakeWatcher('test', watch_loop)
+        multiplexer.start(watcher)
+        self.assertTrue(self.wait_for(lambda: started))
+        multiplexer.start(watcher)
+        self.assertTrue(self.wait_for(lambda: multiplexer.task_count == 1))
+        time.sleep(0.1)
+        self.assertEqual(len(started), 1)
+        multiplexer.stop(watcher)
+        self.assertTrue(self.wait_for(lambda: multiplexer.task_count == 0))
+        multiplexer.shutdown()
+        self.assertTrue(multiplexer.loop.is_closed())
+
+    def test_01(self):
+        # Stream yields objects split across chunks, get raises ApiException on error
+        async def handler(request):
+            if request.path == '/gone':
+                return aiohttp.web.Response(status=410, text='{}')
+            if request.path == '/list':
+                return aiohttp.web.json_response({'items': [], 'watch': request.query.get('watch')})
+            response = aiohttp.web.StreamResponse()
+            await response.prepare(request)
+            for chunk in (b'{"a":', b' 1}\n\n{"b"', b': 2}\n'):
+                await response.write(chunk)
+                await asyncio.sleep(0.01)
+            await response.write_eof()
+            return response
+        multiplexer = WatchMultiplexer(FakeOperative(self.start_server(handler)))
+        results = {}
+        async def watch_loop():
+            try:
+                results['list'] = await multiplexer.get('/list', {'watch': 'true'})
+                results['stream'] = [obj async for obj in multiplexer.stream('/stream', {})]
+                await multiplexer.get('/gone', {})
+            except kubernetes.client.rest.ApiException as e:
+                results['status'] = e.status
+        multiplexer.start(FakeWatcher('test', watch_loop))
+        self.assertTrue(self.wait_for(lambda: 'status' in results))
+        self.assertEqual(results['list'], {'items': [], 'watch': 'true'})
+        self.assertEqual(results['stream'], [{'a': 1}, {'b': 2}])
+        self.assertEqual(results['status'], 410)
+        multiplexer.shutdown()
+
+    def test_02(self):
+        # Handlers run in the handler pool, not on the multiplexer loop
+        multiplexer = WatchMultiplexer(FakeOperative(), handler_workers=2)
+        handled = []
+        def handler(event, logger):
+            handled.append((event, threading.current_thread().name))
+        async def watch_loop():
+            await multiplexer.dispatch(handler, {'type': 'ADDED'}, None)
+        multiplexer.start(FakeWatcher('test', watch_loop))
+        self.assertTrue(self.wait_for(lambda: handled))
+        event, thread_name = handled[0]
+        self.assertEqual(event, {'type': 'ADDED'})
+        self.assertTrue(thread_name.startswith('watch_handler'))
+        multiplexer.shutdown()
+
+    def test_03(self):
+        # Coroutine handlers are awaited on the multiplexer loop
+        multiplexer = WatchMultiplexer(FakeOperative(), handler_workers=2)
+        handled = []
+        async def handler(event, logger):
+            handled.append((event, threading.current_thread().name))
+        async def watch_loop():
+            await multiplexer.dispatch(handler, {'type': 'ADDED'}, None)
+        multiplexer.start(FakeWatcher('test', watch_loop))
+        self.assertTrue(self.wait_for(lambda: handled))
+        self.assertEqual(handled[0], ({'type': 'ADDED'}, 'watch_multiplexer'))
+        multiplexer.shutdown()
+
+    def test_04(self):
+        # Accept header is passed for metadata only requests
+        async def handler(request):
+            return aiohttp.web.json_response({'accept': request.headers['Accept']})
+        multiplexer = WatchMultiplexer(FakeOperative(self.start_server(handler)))
+        results = []
+        async def watch_loop():
+            results.append(await multiplexer.get('/list', {}))
+            results.append(await multiplexer.get('/list', {}, accept='application/json;as=PartialObjectMetadataList;g=meta.k8s.io;v=v1'))
+        multiplexer.start(FakeWatcher('test', watch_loop))
+        self.assertTrue(self.wait_for(lambda: len(results) == 2))
+        self.assertEqual(results, [
+            {'accept': 'application/json'},
+            {'accept': 'application/json;as=PartialObjectMetadataList;g=meta.k8s.io;v=v1'},
+        ])
+        multiplexer.shutdown()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+
+import asyncio
+import copy
+import re
+import threading
+import time
+import unittest
+import sys
+sys.path.append('../operator')
+
+from gpte.util import CoalescingQueue, ExpiryScheduler, LockTable, MatchIndex, TTLCache, TemplatePlan, dict_merge, dict_merged, jinja2envs, jinja2process, recursive_process_template_strings, template_fingerprint
+
+class TestTemplateFingerprint(unittest.TestCase):
+    def test_00(self):
+        a = {'a': 1, 'b': [1, 2]}
+        b = {'b': [1, 2], 'a': 1}
+        self.assertEqual(template_fingerprint(a), template_fingerprint(b))
+
+    def test_01(self):
+        a = {'a': 1}
+        b = {'a': 2}
+        self.assertNotEqual(template_fingerprint(a), template_fingerprint(b))
+
+    def test_02(self):
+        ignore = [re.compile('/spec/guid$')]
+        a = {'spec': {'guid': 'a', 'foo': 'bar'}}
+        b = {'spec': {'guid': 'b', 'foo': 'bar'}}
+        c = {'spec': {'foo': 'bar'}}
+        self.assertEqual(template_fingerprint(a, ignore), template_fingerprint(b, ignore))
+        self.assertEqual(template_fingerprint(a, ignore), template_fingerprint(c, ignore))
+
+    def test_03(self):
+        # Ignored path does not ignore values nested under the path
+        ignore = [re.compile('/spec$')]
+        a = {'spec': {'foo': 'a'}}
+        b = {'spec': {'foo': 'b'}}
+        self.assertNotEqual(template_fingerprint(a, ignore), template_fingerprint(b, ignore))
+
+    def test_04(self):
+        ignore = [re.compile('/items/[0-9]+$')]
+        a = {'items': ['a', 'b']}
+        b = {'items': ['c', 'd']}
+        c = {'items': ['c']}
+        self.assertEqual(template_fingerprint(a, ignore), template_fingerprint(b, ignore))
+        self.assertNotEqual(template_fingerprint(a, ignore), template_fingerprint(c, ignore))
+
+    def test_05(self):
+        ignore = [re.compile('/a~1b$')]
+        a = {'a/b': 1}
+        b = {'a/b': 2}
+        self.assertEqual(template_fingerprint(a, ignore), template_fingerprint(b, ignore))
+
+class TestCoalescingQueue(unittest.TestCase):
+    def test_00(self):
+        queue = CoalescingQueue('test', None, delay=0)
+        queue.put('a', 1)
+        queue.put('b', 2)
+        queue.put('a', 3)
+        self.assertEqual(len(queue), 2)
+        self.assertEqual(queue.wait_for_next(), ('a', 3))
+        self.assertEqual(queue.wait_for_next(), ('b', 2))
+        self.assertEqual(queue.puts, 3)
+        self.assertEqual(queue.coalesced, 1)
+
+    def test_01(self):
+        # Key being processed is not returned again until processing completes
+        queue = CoalescingQueue('test', None, delay=0)
+        queue.put('a', 1)
+        self.assertEqual(queue.wait_for_next(), ('a', 1))
+        queue.put('a', 2)
+        queue.put('b', 3)
+        self.assertEqual(queue.wait_for_next(), ('b', 3))
+        queue.done('a')
+        self.assertEqual(queue.wait_for_next(), ('a', 2))
+
+    def test_02(self):
+        # Item put for a key being processed by another worker is processed
+        # after the first completes without delay
+        started = threading.Event()
+        release = threading.Event()
+        processed = []
+        def callback(key, item):
+            processed.append(item)
+            if item == 1:
+                started.set()
+                release.wait(5)
+        queue = CoalescingQueue('test', callback, delay=0, workers=2)
+        queue.start()
+        queue.put('a', 1)
+        self.assertTrue(started.wait(5))
+        queue.put('a', 2)
+        time.sleep(0.1)
+        self.assertEqual(processed, [1])
+        release.set()
+        deadline = time.monotonic() + 5
+        while len(processed) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(processed, [1, 2])
+
+class TestExpiryScheduler(unittest.TestCase):
+    def test_00(self):
+        scheduler = ExpiryScheduler('test', None)
+        now = time.time()
+        scheduler.schedule('b', now - 1)
+        scheduler.schedule('a', now - 2)
+        scheduler.schedule('c', now - 3)
+        scheduler.cancel('c')
+        self.assertEqual(scheduler.wait_for_next(), 'a')
+        self.assertEqual(scheduler.wait_for_next(), 'b')
+        self.assertEqual(len(scheduler), 0)
+
+    def test_01(self):
+        scheduler = ExpiryScheduler('test', None)
+        now = time.time()
+        scheduler.schedule('a', now - 1)
+        scheduler.schedule('b', now - 2)
+        scheduler.schedule('b', now)
+        self.assertEqual(scheduler.wait_for_next(), 'a')
+        self.assertEqual(scheduler.wait_for_next(), 'b')
+
+class TestDictMerged(unittest.TestCase):
+    def test_00(self):
+        dct = {'a': {'b': 1, 'c': {'d': 2}}, 'e': [1], 'f': {'g': 3}}
+        merge_dct = {'a': {'c': {'d': 4, 'h': 5}}, 'e': {'i': 6}, 'j': 7}
+        expected = copy.deepcopy(dct)
+        dict_merge(expected, merge_dct)
+        result = dict_merged(dct, merge_dct)
+        self.assertEqual(result, expected)
+        # Inputs are unchanged and unmodified values are shared
+        self.assertEqual(dct, {'a': {'b': 1, 'c': {'d': 2}}, 'e': [1], 'f': {'g': 3}})
+        self.assertIs(result['f'], dct['f'])
+        self.assertIs(result['e'], merge_dct['e'])
+        self.assertIsNot(result['a'], dct['a'])
+
+class TestJinja2Process(unittest.TestCase):
+    def test_00(self):
+        self.assertEqual(jinja2process('foo', 'jinja2', {}), 'foo')
+        self.assertEqual(jinja2process('{{ a }}', 'jinja2', {'a': 'b'}), 'b')
+        self.assertEqual(jinja2process('{{ a }}', 'legacy', {'a': 'b'}), '{{ a }}')
+        self.assertEqual(jinja2process('{{: a :}}', 'legacy', {'a': 'b'}), 'b')
+
+    def test_01(self):
+        # Strings which skip rendering must match the rendered result
+        for template in ('foo\n', 'foo\r\nbar', 'foo\n\n', '{ a }'):
+            self.assertEqual(
+                jinja2process(template, 'jinja2', {}),
+                jinja2envs['jinja2'].from_string(template).render()
+            )
+
+class TestTemplatePlan(unittest.TestCase):
+    def test_00(self):
+        template = {
+            'static': {'a': 'b', 'c': [1, 'd']},
+            'dynamic': {'a': '{{ x }}', 'c': [1, '{{ x }}-{{ x }}']},
+            'newline': 'foo\n',
+        }
+        plan = TemplatePlan(template, 'jinja2')
+        result = plan.process({'x': 'y'})
+        self.assertEqual(result, recursive_process_template_strings(template, 'jinja2', {'x': 'y'}))
+        self.assertIs(result['static'], template['static'])
+        self.assertEqual(template['dynamic']['a'], '{{ x }}')
+
+    def test_01(self):
+        template = {'a': 'b'}
+        plan = TemplatePlan(template, 'jinja2')
+        self.assertIs(plan.process({}), template)
+
+class TestLockTable(unittest.TestCase):
+    def test_00(self):
+        table = LockTable()
+        events = []
+
+        async def hold(key, name):
+            async with table.lock(key):
+                events.append(name + '-start')
+                await asyncio.sleep(0.01)
+                events.append(name + '-end')
+
+        async def run():
+            await asyncio.gather(hold('a', 'x'), hold('a', 'y'), hold('b', 'z'))
+
+        asyncio.run(run())
+        self.assertLess(events.index('x-end'), events.index('y-start'))
+        self.assertLess(events.index('z-start'), events.index('x-end'))
+        self.assertEqual(len(table), 0)
+
+class TestMatchIndex(unittest.TestCase):
+    def test_00(self):
+        index = MatchIndex()
+        for i in range(100):
+            index.put('item-{}'.format(i), {
+                'apiVersion': 'v1',
+                'kind': 'Test',
+                'spec': {'item': 'item-{}'.format(i), 'list': [i]},
+            })
+        index.put('empty', {'spec': {}})
+        template = {'apiVersion': 'v1', 'kind': 'Test', 'spec': {'item': 'item-7'}}
+        self.assertEqual(sorted(index.candidates(template)), ['empty', 'item-7'])
+        self.assertEqual(index.candidates({'spec': ['item-7']}), ['empty'])
+
+    def test_01(self):
+        index = MatchIndex()
+        index.put('a', {'kind': 'A'})
+        index.put('b', {'kind': 'B'})
+        self.assertEqual(index.candidates({'kind': 'A'}), ['a'])
+        index.put('a', {'kind': 'C'})
+        self.assertEqual(index.candidates({'kind': 'A'}), [])
+        self.assertEqual(index.candidates({'kind': 'C'}), ['a'])
+        index.remove('a')
+        self.assertEqual(index.candidates({'kind': 'C'}), [])
+        self.assertEqual(len(index), 1)
+
+    def test_02(self):
+        # Candidates include every matching definition
+        index = MatchIndex()
+        matches = {}
+        for i in range(50):
+            match = {'kind': 'K{}'.format(i % 3)}
+            if i % 2:
+                match['spec'] = {'a': i % 5}
+            if i % 7 == 0:
+                match['spec'] = {'b': {'c': True}}
+            matches[i] = match
+            index.put(i, match)
+        for template in (
+            {'kind': 'K1', 'spec': {'a': 3, 'b': {'c': 1}}},
+            {'kind': 'K0', 'spec': {'b': {'c': True}}},
+            {'kind': 'K2'},
+        ):
+            expected = [i for i, match in matches.items() if dict_merged(template, match) == template]
+            self.assertTrue(set(expected) <= set(index.candidates(template)))
+
+class TestTTLCache(unittest.TestCase):
+    def test_00(self):
+        cache = TTLCache('test', 60)
+        self.assertEqual(cache.get('a'), (False, None))
+        cache.put('a', None)
+        self.assertEqual(cache.get('a'), (True, None))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_01(self):
+        cache = TTLCache('test', 0)
+        cache.put('a', 'b')
+        self.assertEqual(cache.get('a'), (False, None))
+        self.assertEqual(len(cache), 0)
+
+    def test_02(self):
+        cache = TTLCache('test', 60)
+        cache.put('a', 'b')
+        cache.invalidate('a')
+        self.assertEqual(cache.get('a'), (False, None))
+
+if __name__ == '__main__':
+    unittest.main()